@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import asyncio
+import aiohttp
+import json as json_lib
+import time
+from typing import Optional
+from urllib.parse import urljoin
+
+import metrics
+import throttle
+from util import AttrDict
+
+
+class AsyncAPI:
+    'https://example.com/'
+
+    def __init__(
+        self,
+        prebuilt_params=None,
+        headers=None,
+        cookies=None,
+        limit_per_host=8,
+        timeout: Optional[float]=30,
+    ):
+        'Initialize the session lazily, as it must be bound to an event loop.'
+        self.prebuilt_params = prebuilt_params or {}
+        self.headers = dict(headers or {})
+        self.cookies = dict(cookies or {})
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+
+    @classmethod
+    def from_session(cls, api, **kwargs) -> 'AsyncAPI':
+        'Inherit the base URL, headers and cookies from a synchronous API.'
+        self = cls(
+            api.prebuilt_params, api.headers, api.cookies.get_dict(), **kwargs)
+        self.__doc__ = api.__doc__
+        return self
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        'Create the connection pool on first use.'
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                cookies=self.cookies,
+                timeout=self.timeout,
+            )
+        return self._session
+
+    async def close(self):
+        'Release all the pooled connections.'
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self) -> 'AsyncAPI':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def request(
+        self, method, path, *, json=True, key=None, timeout=None, **kwargs
+    ):
+        'Send the request; cancelling the calling task aborts it at once.'
+        url = urljoin(self.__doc__, path) if path else self.__doc__
+
+        if key:
+            params = dict(self.prebuilt_params.get(key, {}))
+            kwargs_key = 'params' if method == 'GET' else 'data'
+            params.update(kwargs.get(kwargs_key) or {})
+            kwargs[kwargs_key] = params
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+
+        await throttle.acquire_async(url)
+        start = time.monotonic()
+        try:
+            async with self.session.request(method, url, **kwargs) as response:
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            metrics.observe(url, None, time.monotonic() - start)
+            throttle.feedback(url)
+            raise
+        metrics.observe(
+            url, response.status, time.monotonic() - start, len(body))
+        throttle.feedback(url, response.status)
+
+        response.raise_for_status()
+        return AttrDict(json_lib.loads(body)) if json else response
+
+    def get(self, path, params=None, **kwargs):
+        return self.request('GET', path, params=params, **kwargs)
+
+    def post(self, path, data=None, **kwargs):
+        return self.request('POST', path, data=data, **kwargs)
+
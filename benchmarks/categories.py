@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+'Benchmark the train category lookup against the former linear scan.'
+
+import os.path
+import random
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bot import describe_categories, parse_train_ranges, TrainRangeIndex
+from util import argv, open
+
+
+def linear_category(train_ranges: list, train: str) -> tuple:
+    'The lookup before the index was built, for reference.'
+    return describe_categories(
+        tr.category for tr in train_ranges if train in tr)
+
+
+def synthetic_lines(seed=0) -> list:
+    'Generate a category table shaped like the real one.'
+    rng = random.Random(seed)
+    lines = []
+    for prefix in ['G', 'D', 'C', 'Z', 'T', 'K', 'Y', 'S', 'L', 'X', '']:
+        top = 99999 if not prefix else 9998
+        for n in range(rng.randint(5, 40)):
+            pairs = []
+            for k in range(rng.randint(1, 6)):
+                first = rng.randrange(1, top)
+                last = min(top, first + rng.choice([9, 99, 999, 4999]))
+                pairs.append('%s%d-%s%d' % (prefix, first, prefix, last))
+            category = ('@' if rng.random() < 0.2 else '') + '类别%s%d' % (
+                prefix, n)
+            lines.append(' '.join([category] + pairs))
+    return lines
+
+
+def main(path: str, samples=20000, number=5):
+    if os.path.exists(path):
+        with open(path) as f:
+            lines = f.read().splitlines()
+    else:
+        print('%s not found, using a synthetic category table.' % path)
+        lines = synthetic_lines()
+    train_ranges = list(parse_train_ranges(lines))
+    start = time.perf_counter()
+    index = TrainRangeIndex(train_ranges)
+    print('Indexed %d ranges of %d prefixes in %.1f ms.' % (
+        len(train_ranges), len(index.intervals),
+        (time.perf_counter() - start) * 1000))
+
+    rng = random.Random(1)
+    prefixes = sorted(index.intervals) + ['Q']
+    trains = [
+        rng.choice(prefixes) + str(rng.randrange(1, 100000))
+        for i in range(samples)] + ['', 'G', 'B-1083', '00012']
+    for train in trains:
+        assert index.lookup(train) == linear_category(train_ranges, train), train
+
+    for name, function in [
+        ('linear', lambda: [linear_category(train_ranges, t) for t in trains]),
+        ('bisect', lambda: [index.lookup(t) for t in trains]),
+    ]:
+        seconds = min(timeit.repeat(function, number=1, repeat=number))
+        print('%-8s %8.2f µs per lookup' % (name, seconds / len(trains) * 1e6))
+
+
+if __name__ == '__main__':
+    main(argv(1) or 'trains_text')
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+'Benchmark the compiled FilterFormatter against the uncompiled one.'
+
+import os.path
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import strip_lines, FilterFormatter
+
+
+class LegacyFormatter(string.Formatter):
+    'The formatter before templates were compiled, for reference.'
+
+    def get_field(self, field_name, args, kwargs):
+        first, rest = string._string.formatter_field_name_split(field_name)
+        obj = args[first] if isinstance(first, int) else kwargs.get(first, '')
+
+        for is_attr, i in rest:
+            if is_attr:
+                obj = getattr(obj, i)
+            elif obj:
+                obj = self.format(i, obj, **kwargs)
+            else:
+                obj = ''
+
+        return obj, first
+
+
+# the templates of the bot and tracking.py, with typical arguments
+CASES = {
+    'tracking': (strip_lines('''
+        截至 {eventDate} 时为止，您查询的{shpName[由{}托运{conName}的]}
+        {carNo[ {} 号]}{carType[ {} 型]}{carKind}
+        {cdyStation[已从{cdyAdm}{}站发出，]}
+        {destStation[正前往{destAdm}{}站，]}负责运送{wbNbr[单号为 {} 的]}{cdyName}{cdyName[。该车]}
+        {train[现被编入{}]}{trainOrder[机后第 {} 位]}{train[，]}
+        目前已{arrDep}{eventProvince[位于{}{eventCity}的]}
+        {eventAdm}{eventStation}站
+        {dzlc[，距离终点站{destStation}站还有 {} km]}。
+    '''), (), dict(
+        eventDate='2026-10-19 08:12', shpName='', conName='', carNo='5624520',
+        carType='C70', carKind='敞车', cdyStation='大同', cdyAdm='太原局',
+        destStation='秦皇岛', destAdm='', wbNbr='', cdyName='煤',
+        train=' 80012 次列车', trainOrder='23', arrDep='到达',
+        eventProvince='河北', eventCity='张家口', eventAdm='北京局',
+        eventStation='沙城', dzlc='412')),
+    'flight': (strip_lines('''
+        {airline_name[{}航空公司 ]}
+        {flightnumber[{airline_iata} {} ]}航班，
+        由{origin}出发，飞往{destination}。
+        航班由{tail_owner[ {} 所属]}
+        {full_aircrafttype[ {} 型]}飞机{tailnumber[ {} ]}执飞
+        {filed_departure_time[；预定于 {} 起飞]}
+        {filed_arrival_time[，{} 降落]}
+        {filed_ete[，飞行时间 {}]}
+        {filed_airspeed_kts[，航速 {} 节]}
+        {filed_altitude[，高度 {} 英尺]}
+        {actual_departure_time[；实际于 {} 起飞]}
+        {actual_arrival_time[，{} 降落]}。
+        {route[航路 {}。]}
+    '''), (), dict(
+        airline_name='中国国际', flightnumber='1501', airline_iata='CA',
+        origin='北京首都（PEK，ZBAA）T3 航站楼', destination='上海虹桥（SHA，ZSSS）',
+        tail_owner='', full_aircrafttype='Airbus A350-900', tailnumber='B-1083',
+        filed_departure_time='2026-10-19 09:00:00 CST',
+        filed_arrival_time='2026-10-19 11:15:00 CST', filed_ete='02:15',
+        filed_airspeed_kts=454, filed_altitude=0, route='')),
+    'airport': (
+        '{name}（{alternate_ident}，{code}）{terminal[T{} 航站楼]}', (), dict(
+            name='北京首都', alternate_ident='PEK', code='ZBAA', terminal='3')),
+    'shanghai_qr': (strip_lines('''
+        您查询的 {sku} 号二维码位于{modelTypeName}{modelType} {cdh} 动车
+        组 {coachNo} {coachTypeName[号{}]}车 {seatRowNo} 排 {seatName} 席位。
+        {train[该车组正在担当{}列车。]}
+    '''), ('PQ1234567',), dict(
+        sku='PQ1234567', modelTypeName='复兴号', modelType='CR400BF',
+        cdh='5033', coachNo='05', coachTypeName='二等座', seatRowNo='12',
+        seatName='F', train='由上海虹桥站开往北京南站的 G2 次')),
+    'cr_express': (strip_lines('''
+        {2} 次{1}班列，由{5}站始发，终到{6}站
+        {10[，经由{}]}。列车{12[速度标尺为{}，]}
+        {4[装车站为{}，]}{7[卸车站为{}；]}编组为{9}。
+        {13[{}。]}
+    '''), (
+        '', '中欧', 'X8001', '', '', '重庆团结村', '杜伊斯堡', '', '',
+        '41 辆', '阿拉山口', '', '120 km/h', ''), {}),
+    'model': (strip_lines('''
+        {date[截至 {}，]}列车由{emu_no}担当，
+        交路信息详见 https://moerail.org/#{train_no}。
+    '''), (), dict(date='2026-10-18', emu_no=' CR400AF2001 ', train_no='G1')),
+    'plain': ('{0:>5} {1:,} {name!r:^10}', ('G1', 1318), dict(name='北京南')),
+}
+
+
+def main(number=20000):
+    legacy, compiled = LegacyFormatter(), FilterFormatter()
+    print('%-12s %12s %12s %8s' % ('template', 'legacy µs', 'compiled µs', 'gain'))
+    for name, (template, args, kwargs) in CASES.items():
+        expected = legacy.format(template, *args, **kwargs)
+        assert compiled.format(template, *args, **kwargs) == expected, name
+        times = [
+            timeit.timeit(
+                lambda: f.format(template, *args, **kwargs), number=number
+            ) / number * 1e6
+            for f in (legacy, compiled)
+        ]
+        print('%-12s %12.2f %12.2f %7.1fx' % (name, *times, times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+'Benchmark the loaders of the local datasets on synthetic inputs at scale.'
+
+import contextlib
+import gc
+import importlib
+import json
+import os.path
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import argv, open
+
+try:
+    import resource
+except ImportError:  # on Windows
+    resource = None
+
+# the approximate sizes of the real datasets at the 1x scale
+REAL = dict(
+    stations=3300, days=30, trains=9000, models=5000, trainnets=2000, ranges=120)
+TYPES = 'GDCZTKSY'
+
+
+def scaled(key: str, scale: float) -> int:
+    return max(1, round(REAL[key] * scale))
+
+
+def write_stations(path: str, scale: float, rng: random.Random):
+    'Generate a station_name.js, like "@bjb|北京北|VAP|beijingbei|bjb|0".'
+    dump_stations = importlib.import_module('stations').dump_stations
+    n = scaled('stations', scale)
+    with open(path, 'w') as f:
+        f.write(dump_stations(
+            ['x%d' % i, '车站%d' % i, 'T%05X' % i, 'chezhan%d' % i,
+             'cz%d' % i, str(i)] for i in range(n)))
+
+
+def write_trains(path: str, scale: float, rng: random.Random):
+    'Generate a train_list.js, one day at a time to save memory.'
+    n = scaled('trains', scale)
+    trains = [
+        (
+            '%s%05d%s%d0' % (rng.choice('2456789'), i, TYPES[i % 8], i % 9),
+            '%s%d(车站%d-车站%d)' % (
+                TYPES[i % 8], i // 8 + 1,
+                rng.randrange(scaled('stations', scale)),
+                rng.randrange(scaled('stations', scale))),
+        )
+        for i in range(n)]
+    with open(path, 'w') as f:
+        f.write('var train_list ={')
+        for day in range(REAL['days']):
+            f.write('%s"2026-10-%02d":' % (',' if day else '', day + 1))
+            json.dump({t: [
+                dict(station_train_code=code, train_no=train_no)
+                for train_no, code in trains[i::8]
+            ] for i, t in enumerate(TYPES)}, f, ensure_ascii=False)
+        f.write('}')
+
+
+def write_models(path: str, scale: float, rng: random.Random):
+    'Generate the text output of cache.py, like "G1 CR400AF型".'
+    models = 'CR400AF CR400BF CRH380A CRH380AL CRH2A CRH3C CR300AF'.split()
+    with open(path, 'w') as f:
+        for i in range(scaled('models', scale)):
+            print('G%d' % (i + 1), rng.choice(models) + '型' +
+                  rng.choice(['', '', '重联']), file=f)
+
+
+def write_trainnets(path: str, scale: float, rng: random.Random):
+    'Generate the trainnets database, like "12345 CRH380AL-2541 是……".'
+    with open(path, 'w') as f:
+        for i in range(scaled('trainnets', scale)):
+            print(i + 10000, 'CRH%dA-%04d 是一列%s型动车组，担当 G%d 次列车。' % (
+                i % 7, i, rng.choice('ABC'), rng.randrange(9000)), file=f)
+
+
+def write_ranges(path: str, scale: float, rng: random.Random):
+    'Generate the train number categories, like "直通特快 Z1-Z9998".'
+    with open(path, 'w') as f:
+        for i in range(scaled('ranges', scale)):
+            t = TYPES[i % 8]
+            pairs = ('%s%d-%s%d' % (t, j, t, j + 99) for j in range(1, 1000, 100))
+            print('类别%d' % i, *pairs, file=f)
+
+
+def read(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def stages_of_stations(path: str) -> List[Callable]:
+    stations = importlib.import_module('stations')
+    return [
+        ('read', lambda _: read(path)),
+        ('load_stations', lambda s: list(stations.load_stations(s))),
+    ]
+
+
+def stages_of_trains(path: str) -> List[Callable]:
+    trains = importlib.import_module('trains')
+    return [
+        ('read', lambda _: read(path)),
+        ('load_trains', trains.load_trains),
+        ('parse_trains', lambda data: list(trains.parse_trains(data))),
+        ('sort_trains', trains.sort_trains),
+    ]
+
+
+def stages_of_models(path: str) -> List[Callable]:
+    group = importlib.import_module('group').group
+
+    def run(_):
+        with open(path) as f:
+            return group(f)
+    return [('group', run)]
+
+
+def stages_of_trainnets(path: str) -> List[Callable]:
+    bot = importlib.import_module('bot')
+    return [
+        ('read', lambda _: read(path).splitlines()),
+        ('parse_trainnets', bot.parse_trainnets),
+    ]
+
+
+def stages_of_ranges(path: str) -> List[Callable]:
+    bot = importlib.import_module('bot')
+    return [
+        ('read', lambda _: read(path).splitlines()),
+        ('parse_train_ranges', lambda s: list(bot.parse_train_ranges(s))),
+    ]
+
+
+DATASETS = {
+    'stations': (write_stations, stages_of_stations),
+    'trains': (write_trains, stages_of_trains),
+    'models': (write_models, stages_of_models),
+    'trainnets': (write_trainnets, stages_of_trainnets),
+    'ranges': (write_ranges, stages_of_ranges),
+}
+
+
+def peak_rss() -> float:
+    'Return the peak resident set size of this process in MiB.'
+    if not resource:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def child(dataset: str, path: str) -> Dict[str, Dict[str, float]]:
+    'Run the stages of a dataset in this process, and measure each of them.'
+    results = {}
+    value = None
+    for stage, function in DATASETS[dataset][1](path):
+        gc.collect()
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            start = time.perf_counter()
+            output = function(value)
+            seconds = time.perf_counter() - start
+            rss = peak_rss()
+
+            # run once more with tracemalloc, which slows down the stage
+            tracemalloc.start()
+            try:
+                function(value)
+                allocated = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            finally:
+                tracemalloc.stop()
+        results[stage] = dict(
+            seconds=round(seconds, 4), peak_rss_mb=rss and round(rss, 1),
+            allocated_mb=round(allocated, 1))
+        value = output
+    return results
+
+
+def run(dataset: str, path: str) -> Dict[str, Any]:
+    'Measure a dataset in a fresh process, so that the peak RSS is its own.'
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), 'child', dataset, path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, encoding='utf-8')
+    if process.returncode:
+        lines = process.stderr.strip().splitlines() or ['exit status %d' % (
+            process.returncode)]
+        return dict(error=lines[-1])
+    return json.loads(process.stdout)
+
+
+def compare(new: float, old: float) -> str:
+    return '' if not old or new is None else ' (%+.0f%%)' % (new / old * 100 - 100)
+
+
+def main(output: str, scales: List[float]):
+    'Measure every dataset at each scale, and save the results as JSON.'
+    try:
+        with open(output) as f:
+            previous = json.load(f)
+    except FileNotFoundError:
+        previous = {}
+
+    results = dict(previous)  # keep the results of the other scales
+    with tempfile.TemporaryDirectory() as temp:
+        for scale in scales:
+            key = '%gx' % scale
+            results[key] = {}
+            for dataset, (write, stages) in DATASETS.items():
+                path = os.path.join(temp, dataset)
+                try:
+                    write(path, scale, random.Random(0))
+                except ImportError as e:
+                    print('%-5s %-10s skipped: %s' % (key, dataset, e))
+                    continue
+                size = os.path.getsize(path) / 2 ** 20
+                stages = results[key][dataset] = run(dataset, path)
+                os.remove(path)
+                if 'error' in stages:
+                    print('%-5s %-10s %8.1f MiB  %s' % (
+                        key, dataset, size, stages['error']))
+                    continue
+                for stage, r in stages.items():
+                    old = previous.get(key, {}).get(dataset, {}).get(stage, {})
+                    print('%-5s %-10s %8.1f MiB  %-18s %9.3f s%-7s %s' % (
+                        key, dataset, size, stage, r['seconds'],
+                        compare(r['seconds'], old.get('seconds')),
+                        '  '.join('%s %s MiB%s' % (
+                            name, r[k], compare(r[k], old.get(k)))
+                            for name, k in [('rss', 'peak_rss_mb'),
+                                            ('alloc', 'allocated_mb')])))
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+        f.write('\n')
+    print('Results saved to %s.' % output)
+
+
+if __name__ == '__main__':
+    if argv(1) == 'child':
+        print(json.dumps(child(argv(2), argv(3))))
+    else:
+        main(argv(1) or 'loaders.json',
+             [float(s) for s in sys.argv[2:]] or [1, 10, 100])
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+'Benchmark the parsers of upstream responses against fixtures.'
+
+import gc
+import importlib
+import json
+import os.path
+import sys
+import timeit
+import tracemalloc
+from typing import Callable, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import argv, open
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+TOLERANCE = dict(us=0.5, kb=0.2)  # allowed regression before failing
+
+
+def fixture(name: str) -> str:
+    'Read a recorded (or, if so named, synthetic) response.'
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+
+def crsc():
+    parse = importlib.import_module('tracking').CrscTracking.parse
+    page = fixture('crsc.html')
+    return lambda: parse(page)
+
+
+def hyfw():
+    tracking = importlib.import_module('tracking')
+    s = json.loads(fixture('hyfw.json'))['object']
+    return lambda: tracking.HyfwTracking.decipher(s)
+
+
+def explain():
+    tracking = importlib.import_module('tracking')
+    info = json.loads(fixture('hyfw.json'))['object']
+    info = tracking.HyfwTracking.decipher(info)[0]
+    return lambda: tracking.Tracking().explain(info)
+
+
+def order_page():
+    parse = importlib.import_module('tickets').parse_order_page
+    page = fixture('initDc.html')
+    return lambda: parse(page)
+
+
+def winsky():
+    parse = importlib.import_module('winsky').parse_winsky_page
+    page = fixture('winsky.html')
+    return lambda: list(parse(page))
+
+
+def wifi12306(method: str, key: str) -> Callable:
+    def setup():
+        explain = getattr(importlib.import_module('wifi12306').Wifi12306, method)
+        data = json.loads(fixture('wifi12306.synthetic.json'))[key]
+        return lambda: explain(data)
+    return setup
+
+
+CASES = {
+    'CrscTracking.parse': crsc,
+    'HyfwTracking.decipher': hyfw,
+    'Tracking.explain': explain,
+    'parse_order_page': order_page,
+    'parse_winsky_page': winsky,
+    'explain_stop_time': wifi12306('explain_stop_time', 'stop_time'),
+    'explain_pre_seq_train': wifi12306('explain_pre_seq_train', 'pre_seq_train'),
+    'explain_train_equipment':
+        wifi12306('explain_train_equipment', 'train_equipment'),
+    'explain_train_compile_list':
+        wifi12306('explain_train_compile_list', 'train_compile_list'),
+}
+
+
+def measure(function: Callable) -> Dict[str, float]:
+    'Return the best time in µs and the peak allocation in KiB per call.'
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    us = min(timer.repeat(5, number)) / number * 1e6
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()  # warm up the caches before measuring allocations
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        function()
+        kb = (tracemalloc.get_traced_memory()[1] - start) / 1024
+    finally:
+        tracemalloc.stop()
+    return dict(us=round(us, 2), kb=round(kb, 2))
+
+
+def main(update=False) -> int:
+    'Compare the parsers against the baselines, and return the failures.'
+    try:
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+
+    failures = 0
+    print('%-28s %10s %10s  %s' % ('parser', 'µs/call', 'KiB/call', 'baseline'))
+    for name, setup in CASES.items():
+        try:
+            function = setup()
+        except ImportError as e:
+            print('%-28s skipped: %s' % (name, e))
+            continue
+        result = measure(function)
+        baseline = baselines.get(name)
+        if update:
+            baselines[name] = result
+        regressions = [
+            key for key, limit in TOLERANCE.items()
+            if baseline and result[key] > baseline[key] * (1 + limit)]
+        print('%-28s %10.2f %10.2f  %s' % (
+            name, result['us'], result['kb'],
+            'none, skipped' if not baseline else
+            'REGRESSED (%s)' % ', '.join(regressions) if regressions else
+            '%.2f µs, %.2f KiB' % (baseline['us'], baseline['kb'])))
+        failures += bool(regressions)
+
+    if update:
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write('\n')
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(main(argv(1) == 'update') and 1)
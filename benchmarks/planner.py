@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+'Benchmark the journey planner over a national-scale timetable.'
+
+import os.path
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from planner import Planner, explain_journey
+from timetable import Timetable
+from util import argv
+
+
+def synthetic_stops(stations=3300, lines=300, trains=11000, seed=0):
+    'Generate stop times shaped like the national timetable.'
+    rng = random.Random(seed)
+    names = ['S%04d' % i for i in range(stations)]
+    routes = [rng.sample(names, rng.randint(20, 60)) for i in range(lines)]
+    for n in range(trains):
+        route = rng.choice(routes)
+        first = rng.randrange(len(route) - 5)
+        last = rng.randrange(first + 5, min(first + 25, len(route)) + 1)
+        depart = rng.randrange(5 * 60, 23 * 60)
+        clock = 0
+        for seq, station in enumerate(route[first:last], 1):
+            arrive = depart + clock
+            dwell = 0 if seq == 1 else rng.choice([0, 2, 2, 5, 10])
+            yield (
+                'T%05d' % n, seq, station,
+                '%02d:%02d' % divmod(arrive % 1440, 60),
+                '%02d:%02d' % divmod((arrive + dwell) % 1440, 60),
+                clock * 60000,
+            )
+            clock += dwell + rng.randint(10, 60)
+
+
+def measure(function, *args) -> float:
+    'Return the milliseconds spent on the call.'
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def main(path: str, queries=50):
+    start = time.perf_counter()
+    if os.path.exists(path):
+        planner = Planner.from_timetable(Timetable(path))
+    else:
+        print('%s not found, using a synthetic timetable.' % path)
+        planner = Planner(synthetic_stops())
+    print('Loaded %d stations and %d connections in %.1f s.' % (
+        len(planner.stations), len(planner.dep_time),
+        time.perf_counter() - start))
+
+    rng = random.Random(1)
+    pairs = [rng.sample(planner.stations, 2) for i in range(queries)]
+    for name, function, args in [
+        ('plan (08:00)', planner.plan, (480,)),
+        ('plan_day', planner.plan_day, ()),
+    ]:
+        timings = sorted(measure(function, a, b, *args) for a, b in pairs)
+        print('%-12s median %8.2f ms, p90 %8.2f ms, max %8.2f ms' % (
+            name, statistics.median(timings),
+            timings[int(len(timings) * 0.9)], timings[-1]))
+
+    a, b = pairs[0]
+    print('\nSample: %s -> %s' % (a, b))
+    for j in planner.plan(a, b, 480):
+        print('|', explain_journey(j))
+
+
+if __name__ == '__main__':
+    main(argv(1) or 'timetable.db')
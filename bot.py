@@ -2,11 +2,14 @@
 
 import PIL.Image
 import datetime
+import contextvars
+import copy
 import html
 import io
 import json
 import locale
 import logging
+import metrics
 import mwclient
 import platform
 import random
@@ -18,25 +21,40 @@ import time
 import traceback
 import warnings
 import zbar
-from collections import OrderedDict
-from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from contextlib import redirect_stdout
 from difflib import get_close_matches
+from functools import partial
 from itertools import chain, islice
-from typing import Callable, Dict, Iterable, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
+import throttle
+from circulation import Circulation
 from cqhttp import CQHttp
+from history import History
+from ingest import FairQueue
 from util import argv, open, strip_lines, AttrDict
+from tickets import API
+from traces import Traces
 from trains import load_trains, parse_trains, sort_trains
-from tracking import HyfwTracking, CrscTracking
-from tracking import solve_captcha, CAR_OR_CONTAINER_PATTERN
-from wifi12306 import Wifi12306
+from tracking import Tracking, CrscTracking, HedgedTracking, HyfwSessionPool
+from tracking import CAR_OR_CONTAINER_PATTERN
+from wifi12306 import Wifi12306, MetadataCache
+from winsky import winsky_handler
 
 bot = CQHttp('http://localhost:5700/')
-api = HyfwTracking()
+api = Tracking()
 crsc = CrscTracking()
+hyfw = HyfwSessionPool()
+hedged = HedgedTracking(crsc.track_car, hyfw.track_car)
 wifi = Wifi12306()
+web = API()
 scanner = zbar.ImageScanner()
+dispatcher = ThreadPoolExecutor(8, thread_name_prefix='dispatch')
+ingestion = FairQueue('messages')
+outbox = contextvars.ContextVar('outbox', default=None)
 
 
 def unescape(text: str) -> str:
@@ -79,6 +97,13 @@ def new_request(context):
         return {'approve': True}
 
 
+@bot.server_app.route('/metrics')
+def export_metrics():
+    'Report the upstream request statistics to Prometheus.'
+    content_type = {'Content-Type': 'text/plain; version=0.0.4'}
+    return metrics.export('prometheus'), 200, content_type
+
+
 @bot.on_message()
 def new_message(context):
     'Wraps the message event.'
@@ -93,7 +118,16 @@ def new_message(context):
             return dict(reply=reply, at_sender=False)
         elif context.message_type == 'private':
             return dict(reply=context.raw_message, auto_escape=True)
-    GroupMessageHandler(context)()
+    handler = GroupMessageHandler(context)
+
+    def handle():
+        with throttle.interactive():
+            handler()
+
+    # keep the webhook responsive, and let every group take turns
+    if not ingestion.submit(context.get('group_id') or context.user_id, handle):
+        if handler.notified or handler.mentioned:
+            bot.send(context, '消息太多啦，忙不过来了，请稍后再试~')
 
 
 def parse_loopback(context) -> bool:
@@ -218,16 +252,7 @@ class GroupMessageHandler(AttrDict):
             context.greeting_filter() and
             context.abuse_filter() and
             context.speed_filter() and
-            [
-                context.winsky_filter(i) and
-                context.model_filter(i) and
-                context.train_filter(i) and
-                context.tracking_filter(i) and
-                context.shanghai_filter(i) and
-                context.beijing_filter(i) and
-                context.flight_filter(i)
-                for i in context.identifiers
-            ]
+            context.dispatch()
         )
         if (  # if the message is understandable as a whole, i.e.
             not unknown_items or  # a) greeting keywords found in the message
@@ -261,6 +286,63 @@ class GroupMessageHandler(AttrDict):
         ''', context.raw_message, re.VERBOSE)
         """
 
+    def resolve(context, i: str, box: List[str]) -> bool:
+        'Run the filters of an identifier, holding the replies in the box.'
+        outbox.set(box)
+        return (
+            context.winsky_filter(i) and
+            context.model_filter(i) and
+            context.train_filter(i) and
+            context.tracking_filter(i) and
+            context.shanghai_filter(i) and
+            context.beijing_filter(i) and
+            context.flight_filter(i)
+        )
+
+    def dispatch(context) -> List[bool]:
+        'Resolve the identifiers concurrently, but reply in their order.'
+        def flush_late(box: List[str], future: Future):
+            if future.exception():
+                logging.error(future.exception(), exc_info=future.exception())
+            for message in box:
+                bot.send(context, message)
+
+        jobs = []
+        for i in context.identifiers:
+            box = []  # the replies held until the earlier ones are sent
+            # keep the request priority of the caller in the worker threads,
+            # and give each of them a copy of the context to write to
+            future = dispatcher.submit(
+                contextvars.copy_context().run, copy.copy(context).resolve,
+                i, box)
+            jobs.append((i, box, future))
+
+        deadline = time.monotonic() + limit.get('deadline', 20)
+        results = []
+        for i, box, future in jobs:
+            wait([future], max(0, deadline - time.monotonic()))
+            if not future.done():
+                context.reply('%s 还在查，稍等一下哦~' % context.identifiers[i])
+                future.add_done_callback(partial(flush_late, box))
+                results.append(False)  # pending, but not unknown
+                continue
+            for message in box:
+                bot.send(context, message)
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.error(e, exc_info=True)
+                results.append(False)  # failed, but not unknown either
+        return results
+
+    def reply(context, message: str):
+        'Send the message, or hold it in the outbox of the identifier.'
+        box = outbox.get()
+        if box is None:
+            bot.send(context, message)
+        else:
+            box.append(message)
+
     def share_filter(context) -> bool:
         'Convert QQ share cards to plain messages.'
         match = re.fullmatch(
@@ -382,7 +464,7 @@ class GroupMessageHandler(AttrDict):
             # img_conf = configparser.ConfigParser()
             # img_conf.read('../../data/image/%s.cqimg' % match.group(0))
             # img_resp = requests.get(img_conf['image']['url']).content
-            img_resp = requests.get(img['url']).content
+            img_resp = web.get(img['url'], json=False).content
 
             # with PIL.Image.open(img['file']) as img:
             with PIL.Image.open(io.BytesIO(img_resp)) as img:
@@ -416,11 +498,11 @@ class GroupMessageHandler(AttrDict):
                 reply += '详见 https://trainnets.com/archives/%s。' % url
 
         while i.startswith('CR'):
-            history = requests.get('https://api.moerail.ml/emu/' + i).json()
-            if not history or history[0]['emu_no'] != i:
+            history = limit.history.latest_by_emu(i)
+            if not history or history[0].emu_no != i:
                 break
 
-            latest = AttrDict(history[0])
+            latest = history[0]
             train_no = re.match(r'[A-Z][0-9]+', latest.train_no)
             if train_no:
                 latest.train_no = train_no.group(0)
@@ -437,7 +519,7 @@ class GroupMessageHandler(AttrDict):
 
         if not reply:
             return True
-        bot.send(context, strip_lines(reply))
+        context.reply(strip_lines(reply))
         return context.train_filter(i) and False
 
     def train_filter(context, i: str) -> bool:
@@ -447,11 +529,13 @@ class GroupMessageHandler(AttrDict):
         category_desc, found = get_train_category(freight_train or i)
         current_info = model = {}
         if found:
-            try:
-                current_info = wifi.info_by_train_code(i)
-            except:
-                pass
-            model = get_train_model(i, current_info.get('train_no'))
+            latest = get_train_latest_history(i)
+            parts = ['train_compile_list']
+            if not is_fresh(latest):  # otherwise the history is preferred
+                parts += ['train_equipment', 'train_set_type']
+            report = wifi.train_report(i, parts)
+            current_info = report.info or {}
+            model = get_train_model(i, report, latest)
 
         if current_info:
             current_info.train = category_desc.strip() % current_info.train_code
@@ -476,7 +560,7 @@ class GroupMessageHandler(AttrDict):
             reply += model
         if freight_train in known_traces:
             reply += get_train_trace(freight_train)
-        bot.send(context, reply)
+        context.reply(reply)
 
     def tracking_filter(context, i)-> bool:
         'Solve the CAPTCHA to track freight cars or containers.'
@@ -484,27 +568,18 @@ class GroupMessageHandler(AttrDict):
             reply = '''
                 {} 的车号应该是 {}，我帮你查一下。
             '''.strip().format(i, known_models[i])
-            bot.send(context, reply)
+            context.reply(reply)
             i = known_models[i]
         if not CAR_OR_CONTAINER_PATTERN.fullmatch(i):
             return True
         elif i.isdigit():
-            reply = tracking_handler(crsc.track_car, i)
-            if reply:
-                bot.send(context, reply)
-                return
-            else:
-                method = api.track_car
+            method = hedged.track_car
         else:
-            method = api.track_container
+            method = hyfw.track_container
         try:
-            if 'captcha_solved' not in context:
-                api.fill_captcha(solve_captcha(api.load_captcha()))
-        except:
-            result = None
-        else:
-            context.captcha_solved = True
             result = tracking_handler(method, i)
+        except TimeoutError:
+            result = None
         reply = {
             '没有满足条件的查询结果！': '找不到 {} 呢。',
             '货车追踪失败，请稍后再试！': '噫，{}？不告诉你哦~',
@@ -512,7 +587,7 @@ class GroupMessageHandler(AttrDict):
             None: '{} 没查出来，再试一次吧（',
             0: '找不到 {} 呢。',
         }.get(result, result).format(i)
-        bot.send(context, reply)
+        context.reply(reply)
 
     def wildcard_model_filter(context, i: str) -> bool:
         'Match incomplete model names.'
@@ -530,7 +605,7 @@ class GroupMessageHandler(AttrDict):
             return True
         reply = '%s… 你是指 %s 之类的吗？'
         reply %= (context.identifiers[i], '、'.join(matches[:6]))
-        bot.send(context, reply)
+        context.reply(reply)
 
     def wildcard_train_filter(context, i: str) -> bool:
         'Return the category of a train number as fallback.'
@@ -545,7 +620,7 @@ class GroupMessageHandler(AttrDict):
             reply += '如果您要查询按货车办理的六位编号特种车辆，请在前面补零。'
         else:
             return True
-        bot.send(context, reply)
+        context.reply(reply)
 
     def wiki_filter(context, i=None) -> bool:
         'Return the first article found in a bunch of wiki sites.'
@@ -580,7 +655,7 @@ class GroupMessageHandler(AttrDict):
             thumbnail_url = page.get('thumbnail', {}).get('source')
             if thumbnail_url:
                 page.extract += '[CQ:image,file=%s]' % thumbnail_url
-            bot.send(context, page.extract)
+            context.reply(page.extract)
             return
         return titles
 
@@ -591,20 +666,22 @@ class GroupMessageHandler(AttrDict):
         if 'flight_aware_auth' not in limit:
             return True
 
-        resp = requests.get(
-            url='http://flightxml.flightaware.com/json/FlightXML3/FlightInfoStatus',
+        resp = web.get(
+            'http://flightxml.flightaware.com/json/FlightXML3/FlightInfoStatus',
             params=dict(ident=i, howMany=1),
             auth=limit.flight_aware_auth,
+            json=False,
         )
         flights = resp.json().get('FlightInfoStatusResult', {}).get('flights')
         if not flights:
             return True
         info = flights[0]
 
-        owner = html.unescape(requests.get(
-            url='http://flightxml.flightaware.com/json/FlightXML3/TailOwner',
+        owner = html.unescape(web.get(
+            'http://flightxml.flightaware.com/json/FlightXML3/TailOwner',
             params=dict(ident=i),
             auth=limit.flight_aware_auth,
+            json=False,
         ).json().get('TailOwnerResult', {}).get('owner'))
         if owner and owner != 'Unknown Owner':
             info['tail_owner'] = owner.replace('""', '')
@@ -653,7 +730,7 @@ class GroupMessageHandler(AttrDict):
             {actual_arrival_time[，{} 降落]}。
             {route[航路 {}。]}
         '''
-        bot.send(context, api.format(strip_lines(reply), **info))
+        context.reply(api.format(strip_lines(reply), **info))
 
     def shanghai_filter(context, i) -> bool:
         'Track the electric multiple units operated by CR Shanghai.'
@@ -669,7 +746,7 @@ class GroupMessageHandler(AttrDict):
 
         url = 'https://g.xiuxiu365.cn/railway_api/web/index/train'
         try:
-            info = requests.get(url, dict(pqCode=i), verify=False).json()
+            info = web.get(url, dict(pqCode=i), verify=False, json=False).json()
             assert info['code'] == 200
             info = AttrDict(info['data'])
         except AssertionError:
@@ -690,7 +767,7 @@ class GroupMessageHandler(AttrDict):
                     info.train = ' {0} 次'.format(info.trainName)
             reply = api.format(strip_lines(reply), i, **info)
         finally:
-            bot.send(context, reply)
+            context.reply(reply)
 
     def beijing_filter(context, i) -> bool:
         'Track the electric multiple units operated by CR Beijing.'
@@ -709,7 +786,7 @@ class GroupMessageHandler(AttrDict):
         url = 'https://aymaoto.jtlf.cn/webapi/otoshopping/ewh_getqrcodetrainnoinfo'
         signature = 'qrcode=%s&key=ltRsjkiM8IRbC80Ni1jzU5jiO6pJvbKd' % i
         data = dict(qrCode=i, sign=md5(signature.encode()).hexdigest())
-        info = AttrDict(requests.post(url, data).json())
+        info = AttrDict(web.post(url, data, json=False).json())
         if info.State == 400:
             reply = '找不到这个二维码诶。'
         else:
@@ -724,7 +801,7 @@ class GroupMessageHandler(AttrDict):
             elif info.TrainnoId:
                 info.train = ' {0} 次'.format(info.TrainnoId)
             reply = api.format(strip_lines(reply), **info)
-        bot.send(context, reply)
+        context.reply(reply)
 
     def winsky_filter(context, i) -> bool:
         'Return the first matching item from the aircraft database.'
@@ -750,7 +827,7 @@ class GroupMessageHandler(AttrDict):
             if aircraft['状态'] in aircraft['备注']:
                 aircraft.pop('状态')
             reply = api.format(reply.strip(), **aircraft)
-            bot.send(context, strip_lines(reply))
+            context.reply(strip_lines(reply))
             context.flight_filter(i)
             return
 
@@ -778,16 +855,6 @@ def wiki_extract(site: mwclient.Site, **kwargs) -> Iterable[Dict]:
     yield from site.api(**params)[params.action]['pages'].values()
 
 
-def winsky_handler(registration: str) -> Iterable[AttrDict]:
-    'Identify a civil aircraft by its registration number.'
-    url = 'http://winskywebapp.vipsinaapp.com/winsky/index.php'
-    url += '/home/PlaneInfo/getById?parameter=' + registration
-    page = requests.get(url).text.replace(',', '，')
-    matches = re.findall(r'<td><b>([^<]+)</b></td>\s+<td>([^<]*)</td>', page)
-    for i in range(0, len(matches), 10):
-        yield AttrDict(matches[i:i + 10])
-
-
 def tracking_handler(method: Callable, number: str) -> str:
     'Track rail freight operations, and save the results for later use.'
     try:
@@ -869,14 +936,17 @@ def normalize_freight_train_number(train: str) -> str:
 
 def get_train_category(train: str) -> Tuple[str, bool]:
     'Infer the category of a train number from its range.'
+    return train_index.lookup(train)
+
+
+def describe_categories(categories: Iterable[str]) -> Tuple[str, bool]:
+    'Join the categories, putting the ones marked with "@" in front.'
     results = [' %s 次']
-    for tr in train_ranges:
-        if train not in tr:
-            continue
-        elif tr.category.startswith('@'):
-            results.insert(0, tr.category[1:])
+    for category in categories:
+        if category.startswith('@'):
+            results.insert(0, category[1:])
         else:
-            results.append(tr.category)
+            results.append(category)
     if len(results) == 1:
         results.append('列车')
         return ''.join(results), False
@@ -894,36 +964,29 @@ def get_cr_express(train: str) -> str:
     return api.format(strip_lines(reply), *cr_express[train])
 
 
-def get_train_model(train: str, train_full_no: str) -> str:
+def get_train_model(train: str, report: AttrDict, latest: dict) -> str:
     'Return the rolling stock model used for a train.'
-    latest = get_train_latest_history(train)
+    if report.train_equipment:
+        limit.history.add(
+            (e['date'], e['trainsetName'], train)
+            for e in report.train_equipment)
     reply = ''
 
-    while train_full_no:
-        train_compile_list = wifi.train_compile_list_by_train_no(train_full_no)
-        if train_compile_list:
-            reply = wifi.explain_train_compile_list(train_compile_list)
-
-        outdated = datetime.date.fromordinal(
-            datetime.date.today().toordinal() - limit.get('shelf_life', 90))
-        if latest and latest.date > outdated.isoformat():
-            break
-
-        train_equipment = wifi.train_equipment_by_train_no(train_full_no)
-        if train_equipment:
-            latest = dict(
-                date=train_equipment[0]['date'],
-                emu_no=wifi.explain_train_equipment(train_equipment),
-                train_no=train)
-            break
-
-        train_set_type = wifi.train_set_type_by_train_code(train_full_no)
-        if train_set_type:
-            latest = dict(
-                emu_no='{trainsetType}{trainsetTypeName}'.format_map(
-                    train_set_type),
-                train_no=train)
-        break
+    if report.train_compile_list:
+        reply = wifi.explain_train_compile_list(report.train_compile_list)
+
+    if is_fresh(latest):
+        pass  # prefer the history records if they are fresh enough
+    elif report.train_equipment:
+        latest = dict(
+            date=report.train_equipment[0]['date'],
+            emu_no=wifi.explain_train_equipment(report.train_equipment),
+            train_no=train)
+    elif report.train_set_type:
+        latest = dict(
+            emu_no='{trainsetType}{trainsetTypeName}'.format_map(
+                report.train_set_type),
+            train_no=train)
 
     if latest:
         explain = '''
@@ -932,24 +995,30 @@ def get_train_model(train: str, train_full_no: str) -> str:
         '''
         reply = api.format(strip_lines(explain), **latest) + reply
 
+    siblings = limit.circulation.siblings(train)
+    if len(siblings) > 1:
+        reply += '\n同车底：' + ' → '.join(s.train_code for s in siblings)
+
     return reply
 
 
+def is_fresh(latest: Optional[dict]) -> bool:
+    'Tell whether the latest history record is within the shelf life.'
+    outdated = datetime.date.fromordinal(
+        datetime.date.today().toordinal() - limit.get('shelf_life', 90))
+    return bool(latest) and latest['date'] > outdated.isoformat()
+
+
 def get_train_latest_history(train: str) -> dict:
-    response = requests.get('https://api.moerail.ml/train/,' + train)
-    if response.status_code != 200:
-        return
-    history = response.json()
+    history = limit.history.latest_by_train(train)  # local if upstream fails
     if not history:
         return
 
-    date = history[0]['date']
+    date = history[0].date
     vehicles = []
-    for i, e in enumerate(history):
-        if e['date'] != date:
-            break
-        vehicles.append(e['emu_no'])
-        if any(model in e['emu_no'] for model in 'EJ'):
+    for e in history:
+        vehicles.append(e.emu_no)
+        if any(model in e.emu_no for model in 'EJ'):
             break
 
     if len(vehicles) > 1:
@@ -969,6 +1038,36 @@ def get_train_trace(train: str) -> str:
     return api.format(strip_lines(reply), **known_traces[train])
 
 
+class TrainRangeIndex:
+    'Disjoint intervals of the train ranges for each prefix, for bisection.'
+
+    def __init__(self, train_ranges: Iterable[TrainRange]):
+        'Split the overlapping ranges at their bounds, and describe each part.'
+        by_prefix = defaultdict(list)
+        for tr in train_ranges:
+            by_prefix[tr.prefix].append(tr)
+
+        self.unknown = describe_categories([])
+        self.intervals = {}  # prefix: (sorted starts, descriptions)
+        for prefix, ranges in by_prefix.items():
+            starts = sorted({
+                bound for tr in ranges
+                for bound in (tr.range.start, tr.range.stop)})
+            self.intervals[prefix] = starts, [
+                describe_categories(
+                    tr.category for tr in ranges if start in tr.range)
+                for start in starts]
+
+    def lookup(self, train: str) -> Tuple[str, bool]:
+        'Parse the train number once, and find its interval.'
+        match = TrainRange.TRAIN_NO_PATTERN.fullmatch(train or '')
+        if not match:
+            return self.unknown
+        starts, descriptions = self.intervals.get(match.group(1), ((), ()))
+        i = bisect_right(starts, int(match.group(2))) - 1
+        return descriptions[i] if i >= 0 else self.unknown
+
+
 def parse_train_ranges(lines: Iterable[str]) -> Iterable[TrainRange]:
     'Parse the range rules of train number categories.'
     for line in lines:
@@ -1009,7 +1108,7 @@ def load_database(name: str, path: str, handler=json.load, default=None):
 
 def initialize(config_file: str):
     'Load all the databases.'
-    global limit
+    global limit, known_traces, train_index
     limit = Limit()
     with open(config_file) as f:
         limit.update(json.load(f))
@@ -1020,9 +1119,23 @@ def initialize(config_file: str):
         limit.flight_aware_auth = \
             requests.auth.HTTPBasicAuth(**limit.flight_aware_auth)
 
+    for host, rate in limit.get('rate_limits', {}).items():
+        throttle.configure(host, rate)
+    wifi.cache = MetadataCache(limit.get('metadata_db', 'wifi12306.db'))
+    limit.circulation = Circulation(
+        limit.get('circulation_db', 'circulation.db'))
+    limit.history = History(limit.get('history_db', 'history.db'))
+    hyfw.size = limit.get('tracking_sessions', hyfw.size)
+    hyfw.start()
+    hedged.delay = limit.get('hedge_delay', hedged.delay)
+    for key, value in limit.get('ingestion', {}).items():
+        setattr(ingestion, key, value)  # workers, max_pending, etc.
+    ingestion.start()
+
     wiki_sites = []
     for host, pattern in limit.get('wiki_sites', {}).items():
-        site = mwclient.Site(host, do_init=False)
+        site = mwclient.Site(
+            host, pool=throttle.mount(requests.Session()), do_init=False)
         site.writing_script_pattern = re.compile(pattern)
         wiki_sites.append(site)
     limit.wiki_sites = wiki_sites
@@ -1030,7 +1143,6 @@ def initialize(config_file: str):
     databases = {
         'airports': ['airports_json'],
         'known_models': ['serial_json'],
-        'known_traces': ['traces_json'],
         'trainnets': [
             'trainnets_text',
             lambda f: parse_trainnets(f.read().splitlines()),
@@ -1059,6 +1171,16 @@ def initialize(config_file: str):
         else:
             limit[filename] = filename
         load_database(name, filename, *params)
+    train_index = TrainRangeIndex(train_ranges)
+
+    known_traces = Traces(limit.get('traces_db', 'traces.db'))
+    known_traces.compact()
+    if not len(known_traces) and 'traces_json' in limit:
+        try:
+            with open(limit.traces_json) as f:
+                known_traces.import_json(json.load(f))
+        except FileNotFoundError:
+            pass
 
     scanner_conf = [
         (zbar.SymbolType.NONE, zbar.Config.ENABLE, 0),
@@ -1080,6 +1202,4 @@ if __name__ == '__main__':
         print('Committing changes...')
         with open(limit.serial_json, 'w') as f:
             json.dump(known_models, f)
-        with open(limit.traces_json, 'w') as f:
-            json.dump(known_traces, f)
         print('Goodbye.')
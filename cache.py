@@ -5,7 +5,7 @@ import os.path
 from typing import Iterable, List, TextIO
 
 from shot import Automation
-from trains import load_trains, decompose, path
+from trains import emu_codes, load_trains, path
 from util import argv, open
 
 
@@ -18,16 +18,6 @@ def mkdir(path: str):
         print(msg % path)
 
 
-def emu_codes(data: dict, code_types='DGC') -> Iterable[str]:
-    'Return the train codes within specific categories.'
-    for day, trains in data.items():
-        if not trains:
-            continue
-        for code_type in code_types:
-            for train in trains[code_type]:
-                yield decompose(train['station_train_code'])[0]
-
-
 def unique_trains(file: TextIO) -> List[str]:
     'Return unique and sorted list of train codes.'
     print('Loading...')
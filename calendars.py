@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+from typing import Iterable, List
+
+from trains import load_trains, parse_trains
+from util import argv, open, progress, shell
+from wifi12306 import Wifi12306
+
+
+class RunCalendar:
+    'The running days of every train in a timetable period, as bitsets.'
+
+    def __init__(self, start: date, end: date, path='calendars.db'):
+        'Open the database, where bit i stands for the i-th day of the period.'
+        self.start, self.days = start, (end - start).days + 1
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS calendars (
+                start TEXT, days INTEGER, train_no TEXT, bits BLOB,
+                PRIMARY KEY (start, days, train_no)
+            ) WITHOUT ROWID
+        ''')
+        self.trains = []  # type: List[str]
+        self.by_day = []  # type: List[int]
+
+    def missing(self, train_nos: Iterable[str]) -> List[str]:
+        'Return the trains not yet stored, so that builds can be resumed.'
+        done = {row[0] for row in self.conn.execute(
+            'SELECT train_no FROM calendars WHERE start = ? AND days = ?',
+            (self.start.isoformat(), self.days))}
+        return sorted(set(train_nos).difference(done))
+
+    def fetch(self, wifi: Wifi12306, train_no: str, span=30) -> int:
+        'Query the run rules of a train in chunks of days.'
+        bits = 0
+        for offset in range(0, self.days, span):
+            first = self.start + timedelta(offset)
+            last = self.start + timedelta(min(offset + span, self.days) - 1)
+            for day, running in wifi.run_rule_by_train_no(
+                    train_no, first, last).items():
+                index = (day - self.start).days
+                if running and 0 <= index < self.days:
+                    bits |= 1 << index
+        return bits
+
+    def build(self, wifi: Wifi12306, train_nos: Iterable[str], max_workers=4):
+        'Fetch the calendars of the missing trains with bounded concurrency.'
+        train_nos = self.missing(train_nos)
+        print('%d trains to be fetched.' % len(train_nos))
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = {
+                executor.submit(self.fetch, wifi, train_no): train_no
+                for train_no in train_nos
+            }
+            for future in as_completed(futures):
+                try:
+                    bits = future.result()
+                except Exception as e:
+                    print(futures[future], e)
+                    continue
+                with self.conn:  # commit each train for resumption
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO calendars VALUES (?, ?, ?, ?)',
+                        (self.start.isoformat(), self.days, futures[future],
+                         bits.to_bytes((self.days + 7) // 8, 'little')))
+                progress()
+        print()
+
+    def load(self) -> 'RunCalendar':
+        'Transpose the calendars into a bitset of trains for each day.'
+        rows = self.conn.execute(
+            'SELECT train_no, bits FROM calendars WHERE start = ? AND days = ? '
+            'ORDER BY train_no', (self.start.isoformat(), self.days)).fetchall()
+        self.trains = [train_no for train_no, bits in rows]
+        self.by_day = [0] * self.days
+        for i, (train_no, bits) in enumerate(rows):
+            bits = int.from_bytes(bits, 'little')
+            while bits:
+                day = (bits & -bits).bit_length() - 1
+                self.by_day[day] |= 1 << i
+                bits &= bits - 1
+        return self
+
+    def decode(self, bits: int) -> List[str]:
+        'Convert a bitset of trains into train numbers.'
+        trains = []
+        while bits:
+            low = bits & -bits
+            trains.append(self.trains[low.bit_length() - 1])
+            bits ^= low
+        return trains
+
+    def running_on(self, *days: date) -> List[str]:
+        'List the trains running on all the given days.'
+        bits = -1
+        for day in days:
+            index = (day - self.start).days
+            if not 0 <= index < self.days:
+                raise ValueError('%s is out of the period' % day)
+            bits &= self.by_day[index]
+        return self.decode(bits) if days else list(self.trains)
+
+    def running_every(self, weekday: int) -> List[str]:
+        'List the trains running on every given weekday, with Monday as 0.'
+        first = (weekday - self.start.weekday()) % 7
+        days = [self.start + timedelta(i) for i in range(first, self.days, 7)]
+        return self.running_on(*days) if days else []
+
+
+if __name__ == '__main__':
+    start = date.fromisoformat(argv(2) or date.today().isoformat())
+    end = date.fromisoformat(argv(3) or (start + timedelta(59)).isoformat())
+    c = RunCalendar(start, end)
+    with open(argv(1) or 'train_list.js') as f:
+        train_nos = {t[0] for t in parse_trains(load_trains(f.read()))}
+    c.build(Wifi12306(), train_nos)
+    c.load()
+    shell(vars(), 'len(c.trains) == %d.' % len(c.trains))
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+import json
+import sqlite3
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional
+
+from trains import emu_codes, load_trains, parse_trains
+from util import argv, open, progress, shell, AttrDict
+from wifi12306 import Wifi12306
+
+
+class DisjointSet:
+    'Union-find over hashable items, with path halving.'
+
+    def __init__(self):
+        self.parent = {}  # type: Dict[str, str]
+
+    def find(self, x: str) -> str:
+        self.parent.setdefault(x, x)
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x: str, y: str):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            self.parent[max(x, y)] = min(x, y)
+
+    def groups(self) -> Dict[str, List[str]]:
+        'Map each representative to the members of its set.'
+        groups = defaultdict(list)
+        for x in self.parent:
+            groups[self.find(x)].append(x)
+        return groups
+
+
+class Circulation:
+    'Daily circulation chains of the trainsets, stored in SQLite.'
+
+    def __init__(self, path='circulation.db'):
+        'Open the database and create the indexes.'
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS sequences (
+                    train_code TEXT PRIMARY KEY, query_date TEXT, legs TEXT
+                );
+                CREATE TABLE IF NOT EXISTS chains (
+                    chain INTEGER, seq INTEGER, train_code TEXT,
+                    start_station TEXT, end_station TEXT,
+                    start_time TEXT, end_time TEXT, distance INTEGER,
+                    PRIMARY KEY (chain, seq)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS codes (
+                    train_code TEXT PRIMARY KEY, chain INTEGER
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS depots (
+                    chain INTEGER PRIMARY KEY, date TEXT, bureau TEXT,
+                    deploy_depot TEXT, depot TEXT, trainsets TEXT
+                );
+                CREATE INDEX IF NOT EXISTS depots_by_depot
+                    ON depots (depot, chain);
+                CREATE INDEX IF NOT EXISTS depots_by_deploy_depot
+                    ON depots (deploy_depot, chain);
+            ''')
+
+    def missing(
+        self, train_codes: Iterable[str], query_date: date,
+    ) -> List[str]:
+        'Return the trains not yet crawled on the date, to resume crawls.'
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT train_code, legs FROM sequences WHERE query_date = ?',
+                (query_date.isoformat(),)).fetchall()
+        done = set()
+        for code, legs in rows:
+            done.add(code)  # including the trains covered by other queries
+            for leg in json.loads(legs):
+                done.update(split_codes(leg['trainCode']))
+        return sorted(set(train_codes).difference(done))
+
+    def crawl(
+        self,
+        wifi: Wifi12306,
+        train_codes: Iterable[str],
+        query_date: date=None,
+        max_workers=4,
+    ):
+        'Fetch the preceding and following trains in a worker pool.'
+        query_date = query_date or date.today()
+        train_codes = self.missing(train_codes, query_date)
+        print('%d trains to be crawled.' % len(train_codes))
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = {
+                executor.submit(
+                    wifi.pre_seq_train_by_train_code, code, query_date): code
+                for code in train_codes
+            }
+            for future in as_completed(futures):
+                try:
+                    legs = future.result() or []
+                except Exception as e:
+                    print(futures[future], e)
+                    continue
+                with self.lock, self.conn:  # commit each for resumption
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO sequences VALUES (?, ?, ?)',
+                        (futures[future], query_date.isoformat(),
+                         json.dumps(legs, ensure_ascii=False)))
+                progress()
+        print()
+
+    def build(self, query_date: date=None) -> int:
+        'Merge the sequences of a date (or all) into chains, and count them.'
+        sets, legs, successors = DisjointSet(), {}, defaultdict(set)
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT legs FROM sequences WHERE ?1 IS NULL OR '
+                'query_date = ?1', (query_date and query_date.isoformat(),),
+            ).fetchall()
+        for sequence, in rows:
+            sequence = json.loads(sequence)
+            for leg in sequence:
+                sets.find(leg['trainCode'])
+                legs[leg['trainCode']] = leg
+            for a, b in zip(sequence, sequence[1:]):
+                sets.union(a['trainCode'], b['trainCode'])
+                successors[a['trainCode']].add(b['trainCode'])
+
+        with self.lock, self.conn:
+            self.conn.executescript('DELETE FROM chains; DELETE FROM codes;')
+            chains = sorted(
+                order_chain(members, successors, legs)
+                for members in sets.groups().values())
+            for chain, members in enumerate(chains):
+                self.conn.executemany(
+                    'INSERT INTO chains VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((chain, seq) + normalize_leg(code, legs.get(code, {}))
+                     for seq, code in enumerate(members)))
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO codes VALUES (?, ?)',
+                    ((code, chain) for member in members
+                     for code in split_codes(member)))
+        return len(chains)
+
+    def locate(
+        self, wifi: Wifi12306, train_nos: Dict[str, str], max_workers=4,
+    ):
+        'Look up the depot of each chain by the equipment of any train on it.'
+        with self.lock:
+            done = {row[0] for row in self.conn.execute(
+                'SELECT chain FROM depots')}
+            rows = self.conn.execute(
+                'SELECT train_code, chain FROM codes ORDER BY train_code'
+            ).fetchall()
+        chains = {}
+        for code, chain in rows:
+            if chain not in done and code in train_nos:
+                chains.setdefault(chain, train_nos[code])
+        print('%d chains to be located.' % len(chains))
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = {
+                executor.submit(wifi.train_equipment_by_train_no, train_no):
+                chain for chain, train_no in chains.items()
+            }
+            for future in as_completed(futures):
+                try:
+                    equipment = future.result()
+                except Exception as e:
+                    print(futures[future], e)
+                    continue
+                if not equipment:
+                    continue
+                e = equipment[0]
+                with self.lock, self.conn:
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO depots VALUES '
+                        '(?, ?, ?, ?, ?, ?)', (
+                            futures[future], e.get('date'), e['bureaName'],
+                            e['deploydepotName'], e['depotName'],
+                            ' '.join(i['trainsetName'] for i in equipment)))
+                progress()
+        print()
+
+    def chain_of(self, train_code: str) -> Optional[int]:
+        'Find the chain containing a train.'
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT chain FROM codes WHERE train_code = ?',
+                (train_code,)).fetchone()
+        return row and row[0]
+
+    def legs(self, chain: int) -> List[AttrDict]:
+        'List the trains on a chain in their running order.'
+        fields = (
+            'train_code start_station end_station start_time end_time '
+            'distance'
+        ).split()
+        with self.lock:
+            cursor = self.conn.execute(
+                'SELECT {} FROM chains WHERE chain = ? ORDER BY seq'.format(
+                    ', '.join(fields)), (chain,))
+            return [AttrDict(zip(fields, row)) for row in cursor]
+
+    def siblings(self, train_code: str) -> List[AttrDict]:
+        'List the trains sharing a trainset with a train.'
+        chain = self.chain_of(train_code)
+        return [] if chain is None else self.legs(chain)
+
+    def depot(self, chain: int) -> Optional[AttrDict]:
+        'Return the depot and trainsets of a chain, if known.'
+        fields = 'date bureau deploy_depot depot trainsets'.split()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT {} FROM depots WHERE chain = ?'.format(
+                    ', '.join(fields)), (chain,)).fetchone()
+        return row and AttrDict(zip(fields, row))
+
+    def by_depot(self, name: str) -> Dict[int, List[str]]:
+        'List the chains of a depot, matched by part of its name.'
+        with self.lock:
+            cursor = self.conn.execute('''
+                SELECT c.chain, c.train_code
+                FROM depots d JOIN chains c ON c.chain = d.chain
+                WHERE d.depot LIKE ?1 OR d.deploy_depot LIKE ?1
+                ORDER BY c.chain, c.seq
+            ''', ('%' + name + '%',)).fetchall()
+        chains = defaultdict(list)
+        for chain, code in cursor:
+            chains[chain].append(code)
+        return dict(chains)
+
+
+def order_chain(
+    members: List[str],
+    successors: Dict[str, set],
+    legs: Dict[str, Dict[str, Any]],
+) -> List[str]:
+    'Sort the trains of a chain by the sequences, then by departure time.'
+    def start_time(code: str) -> tuple:
+        return legs.get(code, {}).get('startTime') or '', code
+
+    members = set(members)
+    indegree = dict.fromkeys(members, 0)
+    for code in members:
+        for after in successors.get(code, ()):
+            indegree[after] += 1
+    ready = sorted((c for c in members if not indegree[c]), key=start_time)
+    order = []
+    while ready:
+        code = ready.pop(0)
+        order.append(code)
+        for after in sorted(successors.get(code, ()), key=start_time):
+            indegree[after] -= 1
+            if not indegree[after]:
+                ready.append(after)
+        ready.sort(key=start_time)
+    # conflicting sequences from different days may form cycles
+    order.extend(sorted(members.difference(order), key=start_time))
+    return order
+
+
+def normalize_leg(train_code: str, leg: Dict[str, Any]) -> tuple:
+    'Pick the fields of a leg from the query results.'
+    return (
+        train_code, leg.get('startStation'), leg.get('endStation'),
+        leg.get('startTime'), leg.get('endTime'),
+        int(leg.get('distance') or 0),
+    )
+
+
+def split_codes(train_code: str) -> List[str]:
+    'Expand "G1/2" or "G1/G2" into every train code.'
+    first, *others = train_code.split('/')
+    prefix = first.rstrip('0123456789')
+    return [first] + [c if not c.isdigit() else prefix + c for c in others]
+
+
+if __name__ == '__main__':
+    with open(argv(1) or 'train_list.js') as f:
+        data = load_trains(f.read())
+    codes = set(emu_codes(data))
+    train_nos = {code: train_no for train_no, code, *_ in parse_trains(data)}
+    query_date = date.fromisoformat(argv(2)) if argv(2) else None
+    c = Circulation()
+    wifi = Wifi12306()
+    c.crawl(wifi, codes, query_date)
+    print('%d chains built.' % c.build(query_date or date.today()))
+    c.locate(wifi, train_nos)
+    shell(vars(), 'c.siblings("G1")')
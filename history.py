@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import logging
+import re
+import requests
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, List, Tuple
+
+from circulation import split_codes
+from tickets import API
+from trains import emu_codes, load_trains, parse_trains
+from util import argv, open, progress, shell, AttrDict
+from wifi12306 import Wifi12306
+
+
+class Moerail(API):
+    'https://api.moerail.ml/'
+
+    def train(self, train_code: str) -> List[Dict[str, Any]]:
+        return self.get('train/,' + train_code, json=False).json()
+
+    def emu(self, emu_no: str) -> List[Dict[str, Any]]:
+        return self.get('emu/' + emu_no, json=False).json()
+
+
+class History:
+    'Trainset assignments of (date, emu_no, train_no), stored in SQLite.'
+
+    def __init__(
+        self,
+        path='history.db',
+        upstream: Moerail=None,
+        retry=86400,
+        refresh=7 * 86400,
+    ):
+        'Open the database; refetch known keys after refresh secs, else retry.'
+        self.upstream = upstream or Moerail()
+        self.retry, self.refresh = retry, refresh
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS assignments (
+                    date TEXT, emu_no TEXT, train_no TEXT, rank INTEGER,
+                    PRIMARY KEY (emu_no, date, train_no)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS assignments_by_train
+                    ON assignments (train_no, date, emu_no);
+                CREATE TABLE IF NOT EXISTS fetched (
+                    kind TEXT, key TEXT, time REAL,
+                    PRIMARY KEY (kind, key)
+                ) WITHOUT ROWID;
+            ''')
+            columns = [row[1] for row in self.conn.execute(
+                'PRAGMA table_info(assignments)')]
+            if 'rank' not in columns:  # created by older versions
+                self.conn.execute(
+                    'ALTER TABLE assignments ADD COLUMN rank INTEGER')
+
+    def add(self, rows: Iterable[Tuple[str, str, str]]) -> int:
+        'Save the (date, emu_no, train_no) rows in order, and count the new.'
+        rows = [
+            (normalize_date(d), normalize_emu_no(e), code, rank)
+            for rank, (d, e, t) in enumerate(rows) for code in split_codes(t)]
+        with self.lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO assignments VALUES (?, ?, ?, ?)', rows)
+            return self.conn.total_changes - before
+
+    def latest(self, column: str, value: str) -> List[AttrDict]:
+        'Return the rows on the latest date for a train or a trainset.'
+        assert column in ('emu_no', 'train_no')
+        with self.lock:
+            cursor = self.conn.execute('''
+                SELECT date, emu_no, train_no FROM assignments
+                WHERE {0} = ?1 AND date = (
+                    SELECT max(date) FROM assignments WHERE {0} = ?1)
+                ORDER BY rank, emu_no, train_no
+            '''.format(column), (value,))
+            return [AttrDict(zip(('date', 'emu_no', 'train_no'), row))
+                    for row in cursor]
+
+    def latest_by_train(self, train_code: str, fetch=True) -> List[AttrDict]:
+        'Find the trainsets of a train, asking upstream from time to time.'
+        return self.lookup('train', 'train_no', train_code, fetch)
+
+    def latest_by_emu(self, emu_no: str, fetch=True) -> List[AttrDict]:
+        'Find the trains of a trainset, asking upstream from time to time.'
+        return self.lookup('emu', 'emu_no', normalize_emu_no(emu_no), fetch)
+
+    def lookup(
+        self, kind: str, column: str, key: str, fetch: bool,
+    ) -> List[AttrDict]:
+        'Refresh known keys after refresh secs, unknown ones after retry secs.'
+        rows = self.latest(column, key)
+        try:
+            if fetch and self.fetch(
+                    kind, key, self.refresh if rows else self.retry):
+                rows = self.latest(column, key)
+        except (requests.RequestException, ValueError) as e:
+            logging.warning('%s %s: %r', kind, key, e)  # keep the local rows
+        return rows
+
+    def fetch(self, kind: str, key: str, interval: float=None) -> int:
+        'Import the history from upstream, unless fetched within interval.'
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT time FROM fetched WHERE kind = ? AND key = ?',
+                (kind, key)).fetchone()
+        if interval is None:
+            interval = self.retry
+        if row and row[0] > time.time() - interval:
+            return 0
+        history = getattr(self.upstream, kind)(key) or []
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO fetched VALUES (?, ?, ?)',
+                (kind, key, time.time()))
+        return self.add(
+            (e['date'], e['emu_no'], e['train_no']) for e in history)
+
+    def sweep(self, wifi: Wifi12306, trains: Dict[str, str], max_workers=4):
+        'Record the current trainsets of the trains in a worker pool.'
+        print('%d trains to be checked.' % len(trains))
+        added = 0
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = {
+                executor.submit(wifi.train_equipment_by_train_no, train_no):
+                train_code for train_no, train_code in trains.items()
+            }
+            for future in as_completed(futures):
+                try:
+                    equipment = future.result() or []
+                except Exception as e:
+                    print(futures[future], e)
+                    continue
+                added += self.add(
+                    (e['date'], e['trainsetName'], futures[future])
+                    for e in equipment)
+                progress()
+        print()
+        return added
+
+
+def normalize_date(s: str) -> str:
+    'Convert "20261019" or "2026-10-19 08:00" into "2026-10-19".'
+    digits = ''.join(filter(str.isdigit, s))[:8]
+    return '{}-{}-{}'.format(digits[:4], digits[4:6], digits[6:8])
+
+
+def normalize_emu_no(s: str) -> str:
+    'Convert "CRH380AL-2541" into "CRH380AL2541".'
+    return re.sub(r'[-\s]', '', s).upper()
+
+
+if __name__ == '__main__':
+    with open(argv(1) or 'train_list.js') as f:
+        data = load_trains(f.read())
+    codes = set(emu_codes(data))
+    trains = {n: code for n, code, *_ in parse_trains(data) if code in codes}
+    h = History()
+    print('%d records added.' % h.sweep(Wifi12306(), trains))
+    shell(vars(), 'h.latest_by_train("G1")')
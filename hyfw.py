@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
 import json
-import requests
 from string import ascii_uppercase as alphabet
 from typing import List, Dict
 
+from tickets import API
 from util import repl, progress
+web = API()
 
 
 def stations(pinyin: str) -> List[Dict[str, str]]:
@@ -13,7 +14,7 @@ def stations(pinyin: str) -> List[Dict[str, str]]:
     # http://www.12306.cn/mormhweb/hyfw/hyckcx/
     url = 'http://dynamic.12306.cn/yjcx/doPickJZM'
     params = dict(param=pinyin, type=1, czlx=0)
-    response = requests.post(url, params)
+    response = web.post(url, params, json=False)
     return json.loads(response.text)
 
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Hashable
+
+import metrics
+
+
+class FairQueue:
+    'Run the jobs in a bounded worker pool, taking turns among the groups.'
+
+    def __init__(
+        self,
+        name='messages',
+        workers=4,
+        max_pending=64,
+        max_per_group=8,
+        busy_per_group=1,
+    ):
+        'Shed the jobs beyond the limits instead of queueing them forever.'
+        self.name, self.workers = name, workers
+        self.max_pending, self.max_per_group = max_pending, max_per_group
+        self.busy_per_group = busy_per_group
+        self.queues = OrderedDict()  # type: Dict[Hashable, deque]
+        self.busy = {}  # type: Dict[Hashable, int]
+        self.pending = 0
+        self.cond = threading.Condition()
+        self.threads = []
+
+    def start(self) -> 'FairQueue':
+        'Start the workers, if not started yet.'
+        with self.cond:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(
+                    target=self.work, daemon=True,
+                    name='%s-%d' % (self.name, len(self.threads)))
+                thread.start()
+                self.threads.append(thread)
+        return self
+
+    def submit(self, group: Hashable, job: Callable[[], None]) -> bool:
+        'Queue a job of a group, or return False if overloaded.'
+        with self.cond:
+            queue = self.queues.get(group, ())
+            accepted = (
+                self.pending < self.max_pending and
+                len(queue) < self.max_per_group)
+            if accepted:
+                self.queues.setdefault(group, deque()).append(
+                    (time.monotonic(), job))
+                self.pending += 1
+                self.cond.notify()
+            metrics.enqueue(self.name, self.pending, accepted)
+            return accepted
+
+    def take(self) -> tuple:
+        'Wait for the next group in turn with a job and a free worker.'
+        with self.cond:
+            while True:
+                for group, queue in self.queues.items():
+                    if self.busy.get(group, 0) < self.busy_per_group:
+                        break
+                else:
+                    self.cond.wait()
+                    continue
+                queued, job = queue.popleft()
+                del self.queues[group]
+                if queue:  # move to the end of the turns
+                    self.queues[group] = queue
+                self.busy[group] = self.busy.get(group, 0) + 1
+                self.pending -= 1
+                metrics.dequeue(
+                    self.name, self.pending, time.monotonic() - queued)
+                return group, job
+
+    def done(self, group: Hashable):
+        'Release the worker of a group, and let the waiting groups in.'
+        with self.cond:
+            self.busy[group] -= 1
+            if not self.busy[group]:
+                del self.busy[group]
+            self.cond.notify_all()
+
+    def work(self):
+        'Run the jobs forever, logging their exceptions.'
+        while True:
+            group, job = self.take()
+            try:
+                job()
+            except Exception as e:
+                logging.error(e, exc_info=True)
+            finally:
+                self.done(group)
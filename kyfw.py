@@ -1,8 +1,8 @@
-import requests
 from collections import namedtuple
 from typing import Iterable
 
 from stations import load_stations
+from tickets import API
 
 
 fields = 'pinyin_code name telecode pinyin_full pinyin_short id'
@@ -12,6 +12,6 @@ Station = namedtuple('Station', fields.split())
 def stations() -> Iterable[Station]:
     'Get all the train stations from 12306.'
     url = 'https://kyfw.12306.cn/otn/resources/js/framework/station_name.js'
-    script = requests.get(url).text
+    script = API().get(url, json=False).text
     for s in load_stations(script):
         yield Station(*s)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from util import argv, open
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Endpoint:
+    'Statistics of the requests sent to a single endpoint.'
+
+    __slots__ = 'requests', 'statuses', 'buckets', 'seconds', 'bytes', 'retries'
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = {}  # type: Dict[str, int]
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.seconds = 0.0
+        self.bytes = 0
+        self.retries = 0
+
+
+class Queue:
+    'Statistics of a queue of jobs waiting for the workers.'
+
+    __slots__ = 'depth', 'enqueued', 'shed', 'buckets', 'seconds'
+
+    def __init__(self):
+        self.depth = 0
+        self.enqueued = 0
+        self.shed = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.seconds = 0.0
+
+
+class Metrics:
+    'Collect the request statistics of each upstream endpoint.'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}  # type: Dict[tuple, Endpoint]
+        self.queues = {}  # type: Dict[str, Queue]
+
+    def endpoint(self, url: str) -> Endpoint:
+        'Find the statistics by host and path; the lock must be held.'
+        url = urlsplit(url)
+        key = url.netloc, url.path or '/'
+        if key not in self.endpoints:
+            self.endpoints[key] = Endpoint()
+        return self.endpoints[key]
+
+    def observe(self, url: str, status: Optional[int], seconds: float, size=0):
+        'Record a finished request, or a failed one if status is None.'
+        status_class = '%dxx' % (status // 100) if status else 'error'
+        with self.lock:
+            e = self.endpoint(url)
+            e.requests += 1
+            e.statuses[status_class] = e.statuses.get(status_class, 0) + 1
+            e.buckets[bisect_left(BUCKETS, seconds)] += 1
+            e.seconds += seconds
+            e.bytes += size
+
+    def retry(self, url: str):
+        'Record a request that is about to be sent again.'
+        with self.lock:
+            self.endpoint(url).retries += 1
+
+    def enqueue(self, name: str, depth: int, accepted=True):
+        'Record a job put into a queue, or shed if not accepted.'
+        with self.lock:
+            q = self.queues.setdefault(name, Queue())
+            q.depth = depth
+            if accepted:
+                q.enqueued += 1
+            else:
+                q.shed += 1
+
+    def dequeue(self, name: str, depth: int, seconds: float):
+        'Record a job taken by a worker after waiting in a queue.'
+        with self.lock:
+            q = self.queues.setdefault(name, Queue())
+            q.depth = depth
+            q.buckets[bisect_left(BUCKETS, seconds)] += 1
+            q.seconds += seconds
+
+    def queue_snapshot(self) -> List[dict]:
+        'Return a copy of the queue statistics.'
+        with self.lock:
+            return [
+                dict(
+                    name=name,
+                    depth=q.depth,
+                    enqueued=q.enqueued,
+                    shed=q.shed,
+                    buckets=list(q.buckets),
+                    seconds=q.seconds,
+                )
+                for name, q in sorted(self.queues.items())
+            ]
+
+    def snapshot(self) -> List[dict]:
+        'Return a copy of all the statistics.'
+        with self.lock:
+            return [
+                dict(
+                    host=host,
+                    path=path,
+                    requests=e.requests,
+                    statuses=dict(e.statuses),
+                    buckets=list(e.buckets),
+                    seconds=e.seconds,
+                    bytes=e.bytes,
+                    retries=e.retries,
+                )
+                for (host, path), e in sorted(self.endpoints.items())
+            ]
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
+            self.queues.clear()
+
+
+def to_json(metrics: Metrics) -> str:
+    'Export the statistics as a JSON snapshot.'
+    return json.dumps(dict(
+        buckets=BUCKETS, endpoints=metrics.snapshot(),
+        queues=metrics.queue_snapshot()))
+
+
+def to_prometheus(metrics: Metrics) -> str:
+    'Export the statistics in the Prometheus text exposition format.'
+    lines = []
+
+    def sample(name: str, labels: dict, value):
+        labels = ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"').
+                         replace('\n', r'\n'))
+            for k, v in labels.items()
+        )
+        lines.append('%s{%s} %s' % (name, labels, value))
+
+    endpoints = metrics.snapshot()
+    for name, kind, field in [
+        ('upstream_requests_total', 'counter', 'statuses'),
+        ('upstream_request_seconds', 'histogram', 'buckets'),
+        ('upstream_response_bytes_total', 'counter', 'bytes'),
+        ('upstream_retries_total', 'counter', 'retries'),
+    ]:
+        lines.append('# TYPE %s %s' % (name, kind))
+        for e in endpoints:
+            labels = dict(host=e['host'], path=e['path'])
+            if field == 'buckets':
+                count = 0
+                for le, n in zip(BUCKETS + ('+Inf',), e['buckets']):
+                    count += n
+                    sample(name + '_bucket', dict(labels, le=le), count)
+                sample(name + '_sum', labels, e['seconds'])
+                sample(name + '_count', labels, e['requests'])
+            elif field == 'statuses':
+                for status, n in sorted(e['statuses'].items()):
+                    sample(name, dict(labels, status=status), n)
+            else:
+                sample(name, labels, e[field])
+
+    queues = metrics.queue_snapshot()
+    for name, kind, field in [
+        ('queue_depth', 'gauge', 'depth'),
+        ('queue_jobs_total', 'counter', 'enqueued'),
+        ('queue_shed_total', 'counter', 'shed'),
+        ('queue_wait_seconds', 'histogram', 'buckets'),
+    ]:
+        lines.append('# TYPE %s %s' % (name, kind))
+        for q in queues:
+            labels = dict(queue=q['name'])
+            if field == 'buckets':
+                count = 0
+                for le, n in zip(BUCKETS + ('+Inf',), q['buckets']):
+                    count += n
+                    sample(name + '_bucket', dict(labels, le=le), count)
+                sample(name + '_sum', labels, q['seconds'])
+                sample(name + '_count', labels, count)
+            else:
+                sample(name, labels, q[field])
+    return '\n'.join(lines) + '\n'
+
+
+# add more formats here to plug in other monitoring systems
+exporters = {
+    'json': to_json,
+    'prometheus': to_prometheus,
+}  # type: Dict[str, Callable[[Metrics], str]]
+
+registry = Metrics()
+observe, retry = registry.observe, registry.retry
+enqueue, dequeue = registry.enqueue, registry.dequeue
+
+
+def export(format='json') -> str:
+    'Export the process-wide statistics.'
+    return exporters[format](registry)
+
+
+def save(path: str):
+    'Save the process-wide statistics, in Prometheus format for *.prom files.'
+    format = 'prometheus' if path.endswith('.prom') else 'json'
+    with open(path, 'w') as f:
+        f.write(export(format))
+
+
+if __name__ == '__main__':
+    # pretty print a saved JSON snapshot
+    with open(argv(1) or 'metrics.json') as f:
+        snapshot = json.load(f)
+    for e in snapshot['endpoints']:
+        print(
+            '{requests:6} {average:8.3f}s {bytes:>12,}B {retries:4}R '
+            '{host}{path} {statuses}'.format(
+                average=e['seconds'] / max(e['requests'], 1), **e))
+    for q in snapshot.get('queues', []):
+        print(
+            '{depth:6} {average:8.3f}s {enqueued:>12,}J {shed:4}S '
+            '{name} queue'.format(
+                average=q['seconds'] / max(sum(q['buckets']), 1), **q))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import datetime
+import heapq
+import itertools
+import sys
+import time
+from contextlib import nullcontext
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import throttle
+from tickets import Ticket, Availability, SEAT_COLUMNS, parse_availability
+
+Change = Tuple[Optional[Availability], Optional[Availability]]
+
+
+class Watch:
+    'The last known left tickets between two stations on a given date.'
+
+    def __init__(
+        self,
+        depart: str,
+        arrive: str,
+        date: str,
+        min_interval=30.0,
+        max_interval=900.0,
+        backoff=1.5,
+        urgent_hours=72,
+    ):
+        'Start polling at the shortest interval.'
+        self.depart, self.arrive, self.date = depart, arrive, date
+        self.min_interval, self.max_interval = min_interval, max_interval
+        self.backoff, self.urgent_hours = backoff, urgent_hours
+        self.interval = min_interval
+        self.state = None  # type: Optional[Dict[str, Availability]]
+
+    def __repr__(self):
+        return '<Watch {0.depart}-{0.arrive} {0.date}>'.format(self)
+
+    def update(self, records: List[Availability]) -> List[Change]:
+        'Replace the state, and return the trains whose tickets changed.'
+        state = {r.train_code: r for r in records}
+        old_state, self.state = self.state, state
+        if old_state is None:
+            return []  # nothing to compare with on the first poll
+        changes = [
+            (old_state.get(train), state.get(train))
+            for train in sorted(set(old_state).union(state))
+            if seats(old_state.get(train)) != seats(state.get(train))
+        ]
+        self.adapt(bool(changes))
+        return changes
+
+    def adapt(self, changed: bool):
+        'Poll faster after changes, and slow down while nothing happens.'
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+        # stay alert when the departure is coming
+        hours_left = (self.departure() - datetime.datetime.now())
+        hours_left = hours_left.total_seconds() / 3600
+        urgency = max(0, min(1, hours_left / self.urgent_hours))
+        ceiling = self.min_interval + urgency * (
+            self.max_interval - self.min_interval)
+        self.interval = min(self.interval, ceiling)
+
+    def departure(self) -> datetime.datetime:
+        'Return the earliest departure time among the trains.'
+        times = sorted(r.depart_time for r in (self.state or {}).values())
+        departure = '%s %s' % (self.date, times[0] if times else '00:00')
+        return datetime.datetime.strptime(departure, '%Y-%m-%d %H:%M')
+
+
+class Monitor:
+    'Poll many watches in one session, sharing a single request budget.'
+
+    def __init__(self, ticket: Ticket=None, rate: Optional[float]=0.5):
+        'Limit the requests per second to the host while running, if given.'
+        self.ticket = ticket or Ticket()
+        self.rate = rate
+        self.queue = []  # heap of (due time, sequence number, watch)
+        self.counter = itertools.count()
+
+    def watch(self, depart: str, arrive: str, date: str, **kwargs) -> Watch:
+        'Add a station pair on a given date to the polling schedule.'
+        w = Watch(depart, arrive, date, **kwargs)
+        self.schedule(w, time.monotonic())
+        return w
+
+    def schedule(self, w: Watch, due: float):
+        heapq.heappush(self.queue, (due, next(self.counter), w))
+
+    def poll(self, w: Watch) -> List[Change]:
+        'Query the left tickets once, and compare them with the last state.'
+        trains = self.ticket.query(w.depart, w.arrive, w.date)
+        return w.update([parse_availability(w.date, t) for t in trains])
+
+    def run(self) -> Iterator[Tuple[Watch, Change]]:
+        'Poll the watches when they are due, and yield the changes found.'
+        limit = throttle.override(urlsplit(self.ticket.__doc__).netloc,
+                                  self.rate) if self.rate else nullcontext()
+        with limit:  # the throttle paces the requests, in the background lane
+            while self.queue:
+                due, _, w = heapq.heappop(self.queue)
+                time.sleep(max(0, due - time.monotonic()))
+                if w.date < datetime.date.today().isoformat():
+                    continue  # departed already
+                try:
+                    changes = self.poll(w)
+                except Exception as e:
+                    print(w, repr(e))
+                    w.adapt(changed=False)
+                    changes = []
+                self.schedule(w, time.monotonic() + w.interval)
+                for change in changes:
+                    yield w, change
+
+
+def seats(record: Optional[Availability]) -> Optional[tuple]:
+    'Extract the fields that matter for ticket availability.'
+    if record is not None:
+        return (record.can_buy,) + record[-len(SEAT_COLUMNS):]
+
+
+def explain_change(old: Availability, new: Availability) -> str:
+    'Describe the change of left tickets in a line.'
+    record = new or old
+    prefix = '{0.date} {0.train_code} {0.depart}-{0.arrive}'.format(record)
+    if old is None:
+        return prefix + ' +'
+    elif new is None:
+        return prefix + ' -'
+    diffs = (
+        '%s %s->%s' % (k, getattr(old, k), getattr(new, k))
+        for k in ('can_buy', *SEAT_COLUMNS)
+        if getattr(old, k) != getattr(new, k)
+    )
+    return prefix + ' ' + ' '.join(diffs)
+
+
+def main():
+    'Watch the station pairs given as "depart arrive date" triples.'
+    monitor = Monitor()
+    for depart, arrive, date in zip(*[iter(sys.argv[1:])] * 3):
+        monitor.watch(depart, arrive, date)
+    for w, (old, new) in monitor.run():
+        print(explain_change(old, new))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,27 @@
 #!/usr/bin/env python3
 
+import contextvars
 import datetime
+import heapq
+import itertools
+import re
 import requests
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+from requests.adapters import HTTPAdapter
 
-from util import repl
+from tickets import API
+from util import argv, minutes, repl, AttrDict, DAY
+from wifi12306 import Wifi12306
+
+MAX_WORKERS = 8
+ARRIVAL, DEPARTURE = 0, 1
+
+web = API()
+web.mount('http://', HTTPAdapter(pool_maxsize=MAX_WORKERS))
+executor = ThreadPoolExecutor(MAX_WORKERS)
 
 
 def station_encode(s: str) -> str:
@@ -13,36 +31,266 @@ def station_encode(s: str) -> str:
     )
 
 
-def get_status(train, station, kind) -> requests.Response:
+def get_status(
+    train, station, kind, query_date: datetime.date=None,
+) -> requests.Response:
     url = 'http://dynamic.12306.cn/map_zwdcx/cx.jsp'
     params = {
         'cz': station,
         'cc': train,
         'cxlx': int(kind),
-        'rq': datetime.date.today().isoformat(),
+        'rq': (query_date or datetime.date.today()).isoformat(),
         'czEn': station_encode(station),
     }
     ua = {'User-Agent': 'Mozilla/5.0'}
-    return requests.get(url, params, headers=ua)
+    try:
+        return web.get(url, params, headers=ua, json=False)
+    except requests.HTTPError as e:
+        return e.response
 
 
-def print_status(response: requests.Response):
-    if response.status_code == 200:
-        print('|', response.text.strip())
+def explain_status(response: Optional[requests.Response]) -> str:
+    if response is None:
+        return 'X network error'
+    elif response.status_code == 200:
+        return response.text.strip()
     else:
-        print('X %d error' % response.status_code)
+        return 'X %d error' % response.status_code
+
+
+def query_all(
+    queries: List[Tuple[str, str, int]], query_date: datetime.date=None,
+) -> List[str]:
+    'Send the (train, station, kind) queries concurrently, in order.'
+    def query(args: Tuple[str, str, int]) -> str:
+        try:
+            return explain_status(get_status(*args, query_date))
+        except requests.RequestException:
+            return explain_status(None)
+
+    # keep the request priority of the caller in the worker threads
+    futures = [
+        executor.submit(contextvars.copy_context().run, query, args)
+        for args in queries]
+    return [f.result() for f in futures]
+
+
+def stop_times(
+    train: str, query_date: datetime.date=None, wifi: Wifi12306=None,
+) -> List[AttrDict]:
+    'List the stations of a train with the scheduled times as datetimes.'
+    query_date = query_date or datetime.date.today()
+    stations = (wifi or Wifi12306()).stop_time_by_train_code(train, query_date)
+    start = minutes(stations[0]['startTime']) if stations else None
+    if start is None:
+        return []
+    origin = datetime.datetime.combine(
+        query_date, datetime.time()) + datetime.timedelta(minutes=start)
+    stops = []
+    for i, s in enumerate(stations):
+        arrive_at = minutes(s['arriveTime'])
+        depart_at = minutes(s['startTime'])
+        arrive = depart = None
+        if i and arrive_at is not None:
+            arrive = origin + datetime.timedelta(
+                milliseconds=s['timeSpan'] or 0)
+        if not i:
+            depart = origin
+        elif arrive and depart_at is not None and i < len(stations) - 1:
+            depart = arrive + datetime.timedelta(
+                minutes=(depart_at - arrive_at) % DAY)
+        if arrive or depart:  # skip the stops without a time, like "----"
+            stops.append(AttrDict(
+                station=s['stationName'], arrive=arrive, depart=depart))
+    return stops
+
+
+def route_queries(train: str, stops: List[AttrDict]) -> List[Tuple]:
+    'Skip the arrival at the origin and the departure at the terminal.'
+    return [
+        (train, s.station, kind) for s in stops
+        for kind, t in [(ARRIVAL, s.arrive), (DEPARTURE, s.depart)]
+        if t]
+
+
+def format_table(queries: List[Tuple], results: List[str]) -> str:
+    'Put the arrival and the departure of each station on one row.'
+    rows = {}  # type: Dict[str, List[str]]
+    for (train, station, kind), text in zip(queries, results):
+        rows.setdefault(station, ['', ''])[kind] = text
+    width = max(map(len, rows), default=0)
+    return '\n'.join(
+        '| %s  到：%s  发：%s' % (station.ljust(width, '　'), *texts)
+        for station, texts in rows.items())
+
+
+class Route:
+    'A train being monitored, polling each station only around its time.'
+
+    TIME_PATTERN = re.compile(r'(\d{1,2})[:：](\d{2})')
+
+    def __init__(
+        self,
+        train: str,
+        stops: List[AttrDict],
+        query_date: datetime.date=None,
+        before=1800,
+        after=1800,
+        interval=300,
+    ):
+        'Poll a station from before secs ahead until after secs behind.'
+        self.train, self.stops = train, stops
+        self.query_date = query_date or datetime.date.today()
+        self.before = datetime.timedelta(seconds=before)
+        self.after = datetime.timedelta(seconds=after)
+        self.interval = interval
+        self.delay = datetime.timedelta()  # the latest estimate
+        self.passed = 0  # the index of the first station not yet passed
+        self.known = {}  # type: Dict[Tuple[int, int], str]
+
+    def __repr__(self):
+        return '<Route {0.train} {0.passed}/{1}>'.format(self, len(self.stops))
+
+    def scheduled(self, index: int) -> Iterator[Tuple[int, datetime.datetime]]:
+        s = self.stops[index]
+        for kind, t in [(ARRIVAL, s.arrive), (DEPARTURE, s.depart)]:
+            if t:
+                yield kind, t + self.delay
+
+    def due(self, now: datetime.datetime) -> List[Tuple[str, str, int]]:
+        'Return the queries of the stations whose windows contain now.'
+        return list(dict.fromkeys(  # once for a station visited twice
+            (self.train, self.stops[i].station, kind)
+            for i in range(self.passed, len(self.stops))
+            for kind, t in self.scheduled(i)
+            if t - self.before <= now <= t + self.after))
+
+    def next_window(self, now: datetime.datetime) -> Optional[float]:
+        'Return the seconds to wait, or None if the train has arrived.'
+        starts = [
+            t - self.before
+            for i in range(self.passed, len(self.stops))
+            for kind, t in self.scheduled(i) if t + self.after >= now]
+        if not starts:
+            return None
+        start = min(starts)
+        if start <= now:
+            return self.interval
+        return max(self.interval, (start - now).total_seconds())
+
+    def update(self, query: Tuple[str, str, int], text: str, now=None) -> bool:
+        'Adjust the delay and skip the passed stations; tell if it changed.'
+        train, station, kind = query
+        index = self.locate(station, kind, text)
+        changed = self.known.get((index, kind)) != text
+        self.known[index, kind] = text
+        now = now or datetime.datetime.now()
+        scheduled = self.stops[index][['arrive', 'depart'][kind]]
+        actual = self.parse_time(text, scheduled)
+        if actual is None:
+            return changed
+        self.delay = actual - scheduled
+        if actual + self.after / 6 < now:  # time is up, unlikely to change
+            self.passed = max(self.passed, index + kind)
+        return changed
+
+    def locate(self, station: str, kind: int, text: str) -> int:
+        'Find the stop of a message, by its time if the station recurs.'
+        key = ['arrive', 'depart'][kind]
+
+        def distance(i: int) -> Tuple[datetime.timedelta, bool]:
+            expected = self.stops[i][key] + self.delay
+            actual = self.parse_time(text, expected)
+            return (
+                abs(actual - expected) if actual else datetime.timedelta.max,
+                i < self.passed)
+
+        return min((
+            i for i, s in enumerate(self.stops)
+            if s.station == station and s[key]), key=distance)
+
+    @classmethod
+    def parse_time(
+        cls, text: str, scheduled: datetime.datetime,
+    ) -> Optional[datetime.datetime]:
+        'Pick the time in the message, on the day closest to the schedule.'
+        match = None
+        for match in cls.TIME_PATTERN.finditer(text):
+            pass
+        if not match:
+            return None
+        t = scheduled.replace(
+            hour=int(match.group(1)) % 24, minute=int(match.group(2)))
+        half_day = datetime.timedelta(hours=12)
+        while t - scheduled > half_day:
+            t -= datetime.timedelta(days=1)
+        while scheduled - t > half_day:
+            t += datetime.timedelta(days=1)
+        return t
+
+
+class Daemon:
+    'Monitor many trains, polling their stations only when necessary.'
+
+    def __init__(self, **kwargs):
+        'Pass the keyword arguments to each route.'
+        self.kwargs = kwargs
+        self.queue = []  # heap of (due time, sequence number, route)
+        self.counter = itertools.count()
+
+    def watch(
+        self, train: str, stops: List[AttrDict]=None,
+        query_date: datetime.date=None,
+    ) -> Route:
+        'Add a train, with its stations from the stop times by default.'
+        stops = stops or stop_times(train, query_date)
+        r = Route(train, stops, query_date, **self.kwargs)
+        self.schedule(r, time.monotonic())
+        return r
+
+    def schedule(self, r: Route, due: float):
+        heapq.heappush(self.queue, (due, next(self.counter), r))
+
+    def run(self) -> Iterator[Tuple[Route, Tuple[str, str, int], str]]:
+        'Poll the routes when they are due, and yield the changed messages.'
+        while self.queue:
+            due, _, r = heapq.heappop(self.queue)
+            time.sleep(max(0, due - time.monotonic()))
+            queries = r.due(datetime.datetime.now())
+            results = query_all(queries, r.query_date)
+            for query, text in zip(queries, results):
+                if r.update(query, text):
+                    yield r, query, text
+            wait = r.next_window(datetime.datetime.now())
+            if wait is not None:
+                self.schedule(r, time.monotonic() + wait)
 
 
 def main(options: str):
     options = options.split()
-    if len(options) < 2:
-        print('# usage: train stations')
+    if not options:
+        print('# usage: train [yyyy-mm-dd] [stations]')
         return False
     train, stations = options[0], options[1:]
-    for station in stations:
-        for kind in [0, 1]:
-            print_status(get_status(train, station, kind))
+    query_date = None
+    if stations and re.fullmatch(r'\d{4}-\d{2}-\d{2}', stations[0]):
+        query_date = datetime.date.fromisoformat(stations.pop(0))
+    if stations:
+        queries = [(train, s, kind) for s in stations for kind in [0, 1]]
+    else:
+        queries = route_queries(train, stop_times(train, query_date))
+        if not queries:
+            print('X no stop times')
+            return
+    print(format_table(queries, query_all(queries, query_date)))
 
 
 if __name__ == '__main__':
-    repl(main)
+    if argv(1) == 'daemon':
+        d = Daemon()
+        for train in sys.argv[2:]:
+            d.watch(train)
+        for r, (train, station, kind), text in d.run():
+            print(time.strftime('%H:%M'), train, station, text)
+    else:
+        repl(main)
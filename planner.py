@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left, bisect_right
+from itertools import groupby, islice
+from operator import ge, itemgetter, lt
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from timetable import Timetable
+from util import argv, minutes, repl, AttrDict, DAY
+
+INFINITY = 1 << 30
+
+
+class Planner:
+    'Connection scan over the stop times, for journeys with transfers.'
+
+    def __init__(
+        self,
+        stops: Iterable[Tuple[str, int, str, str, str, int]],
+        transfer_times: Dict[str, int]=None,
+        default_transfer=15,
+        days=2,
+    ):
+        'Build the departure-sorted arrays from the stops grouped by train.'
+        self.stations = []  # type: List[str]
+        self.index = {}  # type: Dict[str, int]
+        self.trains = []  # type: List[str]
+        connections = []
+
+        for train_no, train_stops in groupby(stops, itemgetter(0)):
+            times = list(stop_times(list(train_stops)))
+            stations = [self.station(s) for s, *_ in times]
+            for day in range(days):
+                trip = len(self.trains)
+                self.trains.append(train_no)
+                offset = day * DAY
+                for i in range(len(times) - 1):
+                    connections.append((
+                        times[i][2] + offset, times[i + 1][1] + offset,
+                        stations[i], stations[i + 1], trip))
+        connections.sort()
+
+        # the columns of the connections, as parallel arrays
+        columns = list(zip(*connections)) or [()] * 5
+        self.dep_time, self.arr_time, self.dep_stop, self.arr_stop, \
+            self.trip = map(list, columns)
+
+        transfer_times = transfer_times or {}
+        self.transfer = [
+            transfer_times.get(s, default_transfer) for s in self.stations]
+
+    @classmethod
+    def from_timetable(cls, timetable: Timetable, **kwargs) -> 'Planner':
+        'Load all the stops crawled into the timetable database.'
+        cursor = timetable.conn.execute(
+            'SELECT train_no, seq, station, arrive, depart, time_span '
+            'FROM stops ORDER BY train_no, seq')
+        return cls(cursor, **kwargs)
+
+    def station(self, name: str) -> int:
+        'Return the index of a station, and add it if not found.'
+        if name not in self.index:
+            self.index[name] = len(self.stations)
+            self.stations.append(name)
+        return self.index[name]
+
+    def plan(
+        self, source: str, target: str, depart=0, max_legs=4, horizon=DAY,
+    ) -> List[AttrDict]:
+        'Find the earliest journeys with up to the given number of legs.'
+        s, t = self.index[source], self.index[target]
+        dep_time, arr_time = self.dep_time, self.arr_time
+        dep_stop, arr_stop, trips = self.dep_stop, self.arr_stop, self.trip
+        transfer = self.transfer
+
+        # arrival[k][stop]: the earliest arrival at a stop using k legs
+        arrival = [[INFINITY] * len(self.stations) for k in range(max_legs + 1)]
+        parent = [{} for k in range(max_legs + 1)]
+        fewest = [INFINITY] * len(self.stations)  # fewest legs to reach stops
+        arrival[0][s], fewest[s] = depart, 0
+        trip_legs, trip_board = [INFINITY] * len(self.trains), {}
+        # best[k]: the arrival at the target to beat with up to k legs
+        best = [depart + horizon] * (max_legs + 1)
+
+        first = bisect_left(dep_time, depart)
+        for i, time, trip, stop in zip(
+                range(first, len(dep_time)), islice(dep_time, first, None),
+                islice(trips, first, None), islice(dep_stop, first, None)):
+            if time >= best[1]:
+                break  # no connection can arrive earlier any more
+            legs = trip_legs[trip]
+
+            # board with fewer legs than ever for this trip, if possible
+            if fewest[stop] < legs - 1:
+                for k in range(fewest[stop], min(legs - 1, max_legs)):
+                    if arrival[k][stop] + (transfer[stop] if k else 0) <= time:
+                        legs = trip_legs[trip] = k + 1
+                        trip_board[trip] = i
+                        break
+            if legs > max_legs or time >= best[legs]:
+                continue
+
+            stop, time = arr_stop[i], arr_time[i]
+            if time < arrival[legs][stop]:
+                arrival[legs][stop] = time
+                parent[legs][stop] = i, trip_board[trip]
+                fewest[stop] = min(fewest[stop], legs)
+                if stop == t:
+                    for k in range(legs, max_legs + 1):
+                        best[k] = min(best[k], time)
+
+        journeys, last = [], INFINITY
+        for k in range(1, max_legs + 1):
+            if arrival[k][t] < last:
+                last = arrival[k][t]
+                journeys.append(self.journey(parent, k, t))
+        return journeys
+
+    def journey(self, parent: List[dict], legs: int, stop: int) -> AttrDict:
+        'Follow the parent pointers back to the source.'
+        trips = []
+        for k in range(legs, 0, -1):
+            alight, board = parent[k][stop]
+            trips.append(self.leg(board, alight))
+            stop = self.dep_stop[board]
+        trips.reverse()
+        return AttrDict(
+            depart=trips[0].depart, arrive=trips[-1].arrive,
+            transfers=legs - 1, legs=trips)
+
+    def leg(self, board: int, alight: int) -> AttrDict:
+        'Describe the ride on a trip between two of its connections.'
+        return AttrDict(
+            train_no=self.trains[self.trip[alight]],
+            depart_station=self.stations[self.dep_stop[board]],
+            depart=self.dep_time[board],
+            arrive_station=self.stations[self.arr_stop[alight]],
+            arrive=self.arr_time[alight],
+        )
+
+    def plan_day(
+        self, source: str, target: str, max_legs=4, horizon=DAY,
+    ) -> List[AttrDict]:
+        'Find the Pareto-optimal journeys departing throughout a day.'
+        s, t = self.index[source], self.index[target]
+        dep_time, arr_time = self.dep_time, self.arr_time
+        dep_stop, arr_stop, trips = self.dep_stop, self.arr_stop, self.trip
+        transfer = self.transfer
+        unreachable = ((INFINITY,) * max_legs, (None,) * max_legs)
+
+        # the profile of each stop, with the departures in descending order:
+        # the earliest arrivals at the target using up to k + 1 legs, and
+        # the (boarding, alighting) connections of the first leg
+        departs = [[] for stop in self.stations]  # negated for bisect
+        profiles = [[] for stop in self.stations]
+        # the arrivals and alighting connections when staying on each trip
+        trip_profiles = [None] * len(self.trains)
+
+        # scan backwards, so that the profiles of later departures are ready
+        for i in range(bisect_left(dep_time, DAY + horizon) - 1, -1, -1):
+            stop, trip = arr_stop[i], trips[i]
+            if stop != t and not departs[stop] and not trip_profiles[trip]:
+                continue  # the target can not be reached from here
+
+            if stop == t:
+                arrive, exits = (arr_time[i],) * max_legs, (i,) * max_legs
+            else:
+                arrive, exits = trip_profiles[trip] or unreachable
+                j = bisect_right(
+                    departs[stop], -arr_time[i] - transfer[stop]) - 1
+                if j >= 0:  # transfer to the best journey departing later
+                    later, stay = profiles[stop][j][0], arrive[1:]
+                    if any(map(lt, later, stay)):
+                        arrive = arrive[:1] + tuple(map(min, later, stay))
+                        exits = exits[:1] + tuple(
+                            i if a < b else e
+                            for a, b, e in zip(later, stay, exits[1:]))
+            if arrive[-1] >= INFINITY:
+                continue
+            trip_profiles[trip] = arrive, exits
+
+            # keep the journeys departing here only if any of them is better
+            stop = dep_stop[i]
+            if profiles[stop]:
+                last_arrive, last_legs = profiles[stop][-1]
+                if all(map(ge, arrive, last_arrive)):
+                    continue
+                legs = tuple(
+                    (i, e) if a < b else leg for a, b, e, leg
+                    in zip(arrive, last_arrive, exits, last_legs))
+                arrive = tuple(map(min, arrive, last_arrive))
+                if departs[stop][-1] == -dep_time[i]:
+                    profiles[stop][-1] = arrive, legs
+                    continue
+            else:
+                legs = tuple((i, e) for e in exits)
+            departs[stop].append(-dep_time[i])
+            profiles[stop].append((arrive, legs))
+
+        journeys, later = {}, (INFINITY,) * max_legs
+        for depart, (arrive, legs) in zip(departs[s], profiles[s]):
+            for k in range(max_legs):
+                if arrive[k] < min(later[k], arrive[k - 1] if k else INFINITY):
+                    j = self.follow(departs, profiles, legs[k], k, t)
+                    journeys[j.depart, j.transfers] = j
+            later = arrive
+        return sorted(
+            (j for j in journeys.values() if j.depart < DAY),
+            key=itemgetter('depart', 'arrive'))
+
+    def follow(
+        self, departs: List[list], profiles: List[list], leg: Tuple[int, int],
+        k: int, target: int,
+    ) -> AttrDict:
+        'Follow the profiles of the stops from a first leg to the target.'
+        trips = []
+        while True:
+            trips.append(self.leg(*leg))
+            stop = self.arr_stop[leg[1]]
+            if stop == target:
+                break
+            j = bisect_right(
+                departs[stop],
+                -self.arr_time[leg[1]] - self.transfer[stop]) - 1
+            k -= 1
+            leg = profiles[stop][j][1][k]
+        return AttrDict(
+            depart=trips[0].depart, arrive=trips[-1].arrive,
+            transfers=len(trips) - 1, legs=trips)
+
+
+def stop_times(stops: List[tuple]) -> Iterable[Tuple[str, int, int]]:
+    'Calculate the absolute arrival and departure minutes of each stop.'
+    _, _, _, _, origin_depart, _ = stops[0]
+    origin = minutes(origin_depart) or 0
+    for train_no, seq, station, arrive, depart, time_span in stops:
+        arrival = origin + (time_span or 0) // 60000
+        dwell = 0
+        if minutes(arrive) is not None and minutes(depart) is not None:
+            dwell = (minutes(depart) - minutes(arrive)) % DAY
+        yield station, arrival, arrival + dwell
+
+
+def format_minutes(m: int) -> str:
+    'Convert the minutes to "HH:MM", with a suffix for the following days.'
+    day, m = divmod(m, DAY)
+    return '%02d:%02d' % divmod(m, 60) + ('+%d' % day if day else '')
+
+
+def explain_journey(j: AttrDict) -> str:
+    'Describe a journey in a line.'
+    return '%s-%s %d: ' % (
+        format_minutes(j.depart), format_minutes(j.arrive), j.transfers
+    ) + ' / '.join(
+        '{train_no} {depart_station} {0}-{1} {arrive_station}'.format(
+            format_minutes(leg.depart), format_minutes(leg.arrive), **leg)
+        for leg in j.legs)
+
+
+def main(line: str):
+    'Plan the journeys between two stations for the whole day.'
+    stations = line.split()
+    if len(stations) != 2:
+        print('# usage: depart_station arrive_station')
+        return
+    try:
+        journeys = planner.plan_day(*stations)
+    except KeyError as e:
+        print('Unknown station:', e)
+        return
+    for j in journeys:
+        print('|', explain_journey(j))
+    print('=', len(journeys), '\n')
+
+
+if __name__ == '__main__':
+    print('Loading...')
+    planner = Planner.from_timetable(Timetable(argv(1) or 'timetable.db'))
+    print('Ready, %d connections.' % len(planner.dep_time))
+    repl(main)
@@ -1,58 +1,137 @@
 #!/usr/bin/env python3
 
 import re
+import sqlite3
 import mwclient
-from typing import Iterable, List, Sequence, TextIO
+import requests
+import throttle
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+from typing import Sequence, TextIO, Tuple
 
 from stations import path, load_stations, dump_stations
 from util import argv, open
 
+BATCH = 50  # the most titles or revisions per query for non-bot users
+TEMPLATE = 'Template:Infobox China railway station'
+LOCATION_PATTERN = re.compile(r'车站(?:位置|地址)\s*=(.+\S+)')
+NAME_PATTERN = re.compile(r'(.+)(?:站|乘降所)')
+
 
 class Wikipedia:
 
-    def __init__(self, stations: Sequence[List[str]], provinces: Sequence):
-        'Connect to Chinese Wikipedia.'
-        self.site = mwclient.Site('zh.wikipedia.org')
-        self.template = self.site.pages['T:Infobox China railway station']
+    def __init__(
+        self,
+        stations: Sequence[List[str]],
+        provinces: Sequence,
+        cache='wikipedia.db',
+    ):
+        'Connect to Chinese Wikipedia, and open the cache of the pages.'
+        pool = throttle.mount(requests.Session())
+        self.site = mwclient.Site('zh.wikipedia.org', pool=pool)
 
         self.stations = stations
         self.names = {s[1]: index for index, s in enumerate(stations)}
-        self.provinces = provinces
+        self.match_province = province_matcher(provinces)
+
+        self.conn = sqlite3.connect(cache)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                title TEXT PRIMARY KEY, revid INTEGER, location TEXT
+            )
+        ''')
 
     def fill_missing_provinces(self) -> Sequence[List[str]]:
         'Try to fetch the province field from Chinese Wikipedia.'
-        for station_page in self.template.embeddedin(namespace=0):
-            self.parse_province_abbr(station_page)
+        revisions = self.revisions()
+        known = dict(self.conn.execute('SELECT title, revid FROM pages'))
+        missing = {}  # type: Dict[int, List[str]]
+        for title, (revid, variant) in revisions.items():
+            station = self.station_of(title, variant)
+            if station and not station[-1]:
+                missing[revid] = station
+
+        # download only the pages edited since the last run
+        changed = [r for t, (r, v) in revisions.items()
+                   if r in missing and known.get(t) != r]
+        print('%d pages to be downloaded.' % len(changed))
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?)',
+                self.locations(changed))
+
+        for revid, location in self.conn.execute(
+                'SELECT revid, location FROM pages'):
+            if revid in missing:
+                self.fill_province_abbr(missing[revid], location)
         return self.stations
 
-    def parse_province_abbr(self, page: mwclient.page.Page):
-        'Fill in the province abbreviation of the station location.'
-        match = re.match(r'(.+)(?:站|乘降所)', page.name)
+    def query(self, **kwargs) -> Iterator[Dict]:
+        'Yield the pages in the query results, following the continuations.'
+        kwargs.setdefault('formatversion', 2)
+        while True:
+            result = self.site.get('query', **kwargs)
+            yield from result.get('query', {}).get('pages', [])
+            if 'continue' not in result:
+                return
+            kwargs.update(result['continue'])
+
+    def revisions(self) -> Dict[str, Tuple[int, str]]:
+        'Map the pages embedding the infobox to (revid, zh-cn title).'
+        return {
+            page['title']: (
+                page['lastrevid'],
+                page.get('varianttitles', {}).get('zh-cn', page['title']))
+            for page in self.query(
+                generator='embeddedin', geititle=TEMPLATE, geinamespace=0,
+                geilimit=BATCH, prop='info', inprop='varianttitles')
+        }
+
+    def locations(self, revids: List[int]) -> Iterator[Tuple[str, int, str]]:
+        'Download the pages in batches, and extract the station locations.'
+        for i in range(0, len(revids), BATCH):
+            for page in self.query(
+                    revids='|'.join(map(str, revids[i:i + BATCH])),
+                    prop='revisions', rvprop='ids|content', rvslots='main'):
+                revision = page['revisions'][0]
+                text = revision['slots']['main']['content']
+                match = LOCATION_PATTERN.search(text)
+                if not match:
+                    print(page['title'], 'X')
+                yield page['title'], revision['revid'], match and match.group(1)
+
+    def station_of(self, title: str, variant: str) -> Optional[List[str]]:
+        'Find the station of a page, by its title or the zh-cn variant.'
+        match = NAME_PATTERN.match(title)
         if not match:
-            return print(page.name, '?')
+            return print(title, '?')
 
         name = match.group(1)
         if name not in self.names:
-            name = self.convert(title=name, uselang='zh-cn')
+            match = NAME_PATTERN.match(variant)
+            name = match and match.group(1)
             if name not in self.names:
-                return print(page.name, '/', name, '?')
-
-        station = self.stations[self.names[name]]
-        if station[-1]:
-            return
+                return print(title, '/', name, '?')
+        return self.stations[self.names[name]]
 
-        match = re.search(r'车站(?:位置|地址)\s*=(.+\S+)', page.text())
-        if not match:
-            return print(page.name, 'X')
-
-        for code, abbr, province in self.provinces:
-            if province in match.group(1):
-                station[-1] = abbr
-                return print(station[1], '->', abbr)
-
-    def convert(self, **kwargs) -> str:
-        'Convert between language variants, such as zh-CN and zh-TW.'
-        return self.site.get('parse', **kwargs)['parse']['displaytitle']
+    def fill_province_abbr(self, station: List[str], location: Optional[str]):
+        'Fill in the province abbreviation of the station location.'
+        abbr = location and self.match_province(location)
+        if abbr and not station[-1]:
+            station[-1] = abbr
+            print(station[1], '->', abbr)
+
+
+def province_matcher(provinces: Sequence) -> Callable[[str], Optional[str]]:
+    'Build a matcher preferring the provinces listed earlier, as before.'
+    priority = {province: (index, abbr)
+                for index, (code, abbr, province) in enumerate(provinces)}
+    pattern = re.compile('|'.join(
+        map(re.escape, sorted(priority, key=len, reverse=True))))
+
+    def match(location: str) -> Optional[str]:
+        found = set(pattern.findall(location))
+        return found and priority[min(found, key=priority.get)][1] or None
+    return match
 
 
 def load_provices(file: TextIO) -> Iterable[List[str]]:
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+# the lanes of waiting requests, the smaller one goes first
+INTERACTIVE, BACKGROUND = 0, 1
+lane = contextvars.ContextVar('lane', default=BACKGROUND)
+
+
+class Host:
+    'The token bucket and the waiting line of an upstream host.'
+
+    def __init__(self, rate: Optional[float], burst: Optional[float]):
+        'Start with a full bucket; a rate of None means unlimited.'
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.last_check = time.monotonic()
+        self.slowdown = 1.0
+        self.cond = threading.Condition()
+        self.waiting = []  # heap of (lane, sequence number)
+        self.wakers = {}  # type: Dict[tuple, Callable[[], None]]
+
+    def wait_time(self) -> float:
+        'Refill the bucket, and return the seconds until a token is ready.'
+        if self.rate is None:
+            return 0
+        now = time.monotonic()
+        rate = self.rate / self.slowdown
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last_check) * rate)
+        self.last_check = now
+        return max(0, (1 - self.tokens) / rate)
+
+    def wake_head(self):
+        'Tell the waiters that the line has moved; the lock must be held.'
+        self.cond.notify_all()
+        if self.waiting and self.waiting[0] in self.wakers:
+            self.wakers.pop(self.waiting[0])()
+
+
+class Scheduler:
+    'Share the request budget of each upstream host among all the sessions.'
+
+    def __init__(self, rate: float=None, burst: float=None, max_slowdown=32.0):
+        'Set the default number of requests per second, unlimited by default.'
+        self.rate, self.burst, self.max_slowdown = rate, burst, max_slowdown
+        self.rates = {}  # type: Dict[str, Tuple[float, float]]
+        self.hosts = {}  # type: Dict[str, Host]
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def rate_of(self, netloc: str) -> Tuple[Optional[float], Optional[float]]:
+        'Look up the rate of a host, or of its closest configured domain.'
+        labels = netloc.split('.')
+        for i in range(len(labels)):
+            domain = '.'.join(labels[i:])
+            if domain in self.rates:
+                return self.rates[domain]
+        return self.rate, self.burst or self.rate
+
+    def refresh(self):
+        'Apply the configured rates to the known hosts; the lock must be held.'
+        for netloc, host in self.hosts.items():
+            with host.cond:
+                host.rate, host.burst = self.rate_of(netloc)
+                if host.rate is not None:
+                    host.tokens = host.burst if host.tokens is None else min(
+                        host.tokens, host.burst)
+                host.wake_head()
+
+    def configure(self, host: str, rate: Optional[float], burst: float=None):
+        'Override the request rate of a host, or a domain and its subdomains.'
+        with self.lock:
+            self.rates[host] = rate, burst or rate
+            self.refresh()
+
+    @contextmanager
+    def override(self, host: str, rate: Optional[float], burst: float=None):
+        'Change the request rate of a host only within the context.'
+        with self.lock:
+            previous = self.rates.get(host)
+        self.configure(host, rate, burst)
+        try:
+            yield
+        finally:
+            with self.lock:
+                if previous is None:
+                    del self.rates[host]
+                else:
+                    self.rates[host] = previous
+                self.refresh()
+
+    def host(self, url: str) -> Host:
+        'Find the bucket of a host.'
+        netloc = urlsplit(url).netloc
+        with self.lock:
+            if netloc not in self.hosts:
+                self.hosts[netloc] = Host(*self.rate_of(netloc))
+            return self.hosts[netloc]
+
+    def enqueue(self, host: Host, priority: Optional[int]) -> tuple:
+        'Take a number in the waiting line; the lock must be held.'
+        ticket = (lane.get() if priority is None else priority,
+                  next(self.counter))
+        heapq.heappush(host.waiting, ticket)
+        return ticket
+
+    def poll(self, host: Host, ticket: tuple) -> Optional[float]:
+        'Take a token if it is our turn, otherwise return the time to wait.'
+        if host.waiting[0] != ticket:
+            return None  # until woken up
+        wait = host.wait_time()
+        if wait:
+            return wait
+        if host.rate is not None:
+            host.tokens -= 1
+        heapq.heappop(host.waiting)
+        host.wake_head()
+        return 0
+
+    def withdraw(self, host: Host, ticket: tuple):
+        'Leave the waiting line without a token; the lock must be held.'
+        host.wakers.pop(ticket, None)
+        if ticket in host.waiting:
+            host.waiting.remove(ticket)
+            heapq.heapify(host.waiting)
+            host.wake_head()
+
+    def acquire(self, url: str, priority: int=None):
+        'Block until a request to the host is allowed.'
+        host = self.host(url)
+        if host.rate is None and not host.waiting:
+            return
+        with host.cond:
+            ticket = self.enqueue(host, priority)
+            try:
+                wait = self.poll(host, ticket)
+                while wait != 0:
+                    host.cond.wait(wait)
+                    wait = self.poll(host, ticket)
+            except BaseException:
+                self.withdraw(host, ticket)
+                raise
+
+    async def acquire_async(self, url: str, priority: int=None):
+        'Wait in the event loop until a request to the host is allowed.'
+        host = self.host(url)
+        if host.rate is None and not host.waiting:
+            return
+        loop = asyncio.get_running_loop()
+        with host.cond:
+            ticket = self.enqueue(host, priority)
+        try:
+            while True:
+                with host.cond:
+                    wait = self.poll(host, ticket)
+                    if wait is None:  # woken up when it becomes our turn
+                        turn = loop.create_future()
+                        host.wakers[ticket] = partial(
+                            loop.call_soon_threadsafe, resolve, turn)
+                if wait == 0:
+                    return
+                elif wait is None:
+                    await turn
+                else:
+                    await asyncio.sleep(wait)
+        except BaseException:
+            with host.cond:
+                self.withdraw(host, ticket)
+            raise
+
+    def feedback(self, url: str, status: Optional[int]=None, blocked=False):
+        'Slow down on signs of being blocked, and recover gradually.'
+        host = self.host(url)
+        with host.cond:
+            if blocked or not status or status == 429 or status >= 500:
+                host.slowdown = min(host.slowdown * 2, self.max_slowdown)
+            else:
+                host.slowdown = max(1.0, host.slowdown * 0.95)
+
+
+def resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ThrottledAdapter(HTTPAdapter):
+    'Throttle the sessions created by third-party libraries, like mwclient.'
+
+    def send(self, request, *args, **kwargs):
+        acquire(request.url)
+        try:
+            response = super().send(request, *args, **kwargs)
+        except Exception:
+            feedback(request.url)
+            raise
+        feedback(request.url, response.status_code)
+        return response
+
+
+@contextmanager
+def interactive():
+    'Let the requests sent in this context go before background jobs.'
+    token = lane.set(INTERACTIVE)
+    try:
+        yield
+    finally:
+        lane.reset(token)
+
+
+def mount(session):
+    'Route all the requests of a foreign session through the scheduler.'
+    adapter = ThrottledAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+scheduler = Scheduler()
+scheduler.configure('12306.cn', 8.0, 16.0)
+scheduler.configure('kyfw.12306.cn', 2.0, 4.0)  # bans eager ticket clients
+acquire, acquire_async = scheduler.acquire, scheduler.acquire_async
+configure, override = scheduler.configure, scheduler.override
+feedback = scheduler.feedback
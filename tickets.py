@@ -1,18 +1,36 @@
 #!/usr/bin/env python3
 
+import asyncio
+import contextlib
+import csv
 import datetime
 import io
 import json
 import os.path
 import re
 import requests
+import sqlite3
+import time
+from collections import namedtuple
 from getpass import getpass
-from typing import BinaryIO, Iterable, Tuple
-from urllib.parse import unquote, urljoin
+from typing import AsyncIterator, BinaryIO, Iterable, List, Optional, Tuple
+from urllib.parse import unquote, urljoin, urlsplit
 
+import metrics
+import throttle
 from util import module_dir, open, shell, strip_lines, AttrDict
 today = datetime.date.today().isoformat()
 
+# column indexes of the seat counts in the left ticket query results
+SEAT_COLUMNS = dict(
+    gr=21, rw=23, rz=24, tz=25, wz=26, yw=28, yz=29, ze=30, zy=31, swz=32, srrb=33
+)
+PLENTY = 20  # 12306 shows "有" instead of the count for 20 tickets or more
+
+fields = 'date train_no train_code depart arrive depart_time arrive_time'
+fields += ' duration can_buy ' + ' '.join(SEAT_COLUMNS)
+Availability = namedtuple('Availability', fields.split())
+
 
 class API(requests.Session):
     'https://example.com/'
@@ -31,7 +49,19 @@ class API(requests.Session):
             params.update(kwargs.get(kwargs_key, {}))
             kwargs[kwargs_key] = params
 
-        response = super().request(method, url, *args, **kwargs)
+        throttle.acquire(url)
+        start = time.monotonic()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            metrics.observe(url, None, time.monotonic() - start)
+            throttle.feedback(url)
+            raise
+        metrics.observe(
+            url, response.status_code, time.monotonic() - start,
+            len(response.content))
+        throttle.feedback(url, response.status_code)
+
         response.raise_for_status()
         return AttrDict(response.json()) if json else response
 
@@ -39,40 +69,208 @@ class API(requests.Session):
 class Ticket(API):
     'https://kyfw.12306.cn/'
 
-    def __init__(self, persist_cookies='cookies.json'):
-        'Load the headers and cookies from external files.'
+    def __init__(self, persist_cookies='cookies.json', max_age=1800):
+        'Load the headers, and restore the recent session without a request.'
         with open(module_dir('tickets.json')) as f:
             params = json.load(f)
-        super().__init__(params, params.pop('headers'))
+        headers = params.pop('headers')
+        super().__init__(params)
+        self.headers.update(headers)
 
         self.persist_cookies = persist_cookies
-        if persist_cookies:
-            if os.path.exists(persist_cookies):
-                with open(persist_cookies) as f:
-                    cj = requests.utils.cookiejar_from_dict(json.load(f))
-                self.session.cookies = cj
-
-        self.init_query_path()
+        self._query_path = None
+        if persist_cookies and os.path.exists(persist_cookies):
+            with open(persist_cookies) as f:
+                state = json.load(f)
+            if 'cookies' not in state:  # cookies saved by older versions
+                state = dict(cookies=state)
+            if time.time() - state.get('timestamp', 0) < max_age:
+                self.cookies.update(state['cookies'])
+                self._query_path = state.get('query_path')
+
+    @property
+    def query_path(self) -> str:
+        'Discover the API endpoint on first use.'
+        if not self._query_path:
+            self.init_query_path()
+        return self._query_path
 
     def init_query_path(self):
         'Get the API endpoint, which varies between "queryA" and "queryZ".'
         response = self.post('otn/leftTicket/init', json=False)
         query_path_pattern = re.compile("var CLeftTicketUrl = '(.+)';")
-        self.query_path = query_path_pattern.search(response.text).group(1)
+        self._query_path = query_path_pattern.search(response.text).group(1)
+        self.save_state()
+
+    @staticmethod
+    def query_params(depart: str, arrive: str, date=today, student=False):
+        'Build the query string for the left ticket API.'
+        return AttrDict([
+            ('leftTicketDTO.train_date', date),
+            ('leftTicketDTO.from_station', depart),
+            ('leftTicketDTO.to_station', arrive),
+            ('purpose_codes', '0x00' if student else 'ADULT')
+        ])
 
     def query(self, depart: str, arrive: str, date=today, student=False):
         'List trains between two stations.'
-        response = self.get(
-            'otn/' + self.query_path,
-            params=AttrDict([
-                ('leftTicketDTO.train_date', date),
-                ('leftTicketDTO.from_station', depart),
-                ('leftTicketDTO.to_station', arrive),
-                ('purpose_codes', '0x00' if student else 'ADULT')
-            ])
-        )
+        params = self.query_params(depart, arrive, date, student)
+        response = self.query_left_tickets(params)
+        if response is None:  # the endpoint has moved
+            metrics.retry(urljoin(self.__doc__, 'otn/' + self._query_path))
+            self.init_query_path()
+            response = self.query_left_tickets(params)
+        assert response, 'Query path %r is outdated' % self._query_path
         return [train.split('|') for train in response.data['result']]
 
+    def query_left_tickets(
+        self, params: dict, follow=True,
+    ) -> Optional[AttrDict]:
+        'Return None if the saved query path is no longer valid.'
+        path = 'otn/' + self.query_path
+        try:
+            response = self.get(
+                path, params=params,
+                json=False, allow_redirects=False,
+            )
+        except requests.HTTPError as e:
+            if e.response.status_code == 404:
+                return
+            raise
+        results = self.left_ticket_results(
+            response.status_code, response.content)
+        if results is None and follow and path != 'otn/' + self._query_path:
+            # once with the told endpoint, in case the hint is also outdated
+            metrics.retry(urljoin(self.__doc__, path))
+            return self.query_left_tickets(params, follow=False)
+        return results
+
+    def left_ticket_results(
+        self, status: int, body: bytes,
+    ) -> Optional[AttrDict]:
+        'Parse the query results, or return None if the endpoint has moved.'
+        if status == 404 or 300 <= status < 400:
+            return
+        response = AttrDict(json.loads(body))
+        if response.get('c_url'):  # the new endpoint is told sometimes
+            self._query_path = response.c_url
+            self.save_state()
+            return
+        return response
+
+    async def scan(
+        self,
+        pairs: Iterable[Tuple[str, str]],
+        dates: Iterable[str],
+        rate: float=None,
+        concurrency=8,
+        student=False,
+        attempts=3,
+    ) -> AsyncIterator[List[Availability]]:
+        'Query each station pair on each date, yielding results as they come.'
+        import aiohttp
+        from aio import AsyncAPI
+        loop = asyncio.get_running_loop()
+        # discovering the endpoint blocks, so keep it out of the event loop
+        await loop.run_in_executor(None, getattr, self, 'query_path')
+        limit = throttle.override(urlsplit(self.__doc__).netloc, rate) \
+            if rate else contextlib.nullcontext()
+        moving = asyncio.Lock()
+        jobs = asyncio.Queue(concurrency)  # type: asyncio.Queue
+        results = asyncio.Queue(concurrency)  # type: asyncio.Queue
+        failures = []  # type: List[Tuple[str, str, str, Exception]]
+        total = 0
+
+        async def query(depart: str, arrive: str, date: str) -> AttrDict:
+            'Follow the endpoint as query_left_tickets and query do.'
+            params = self.query_params(depart, arrive, date, student)
+            for attempt in range(attempts):
+                path = 'otn/' + self._query_path
+                try:
+                    response = await api.get(
+                        path, params=params, json=False, allow_redirects=False)
+                    status, body = response.status, await response.read()
+                except aiohttp.ClientResponseError as e:
+                    if e.status != 404:
+                        raise
+                    status, body = e.status, b''
+                response = self.left_ticket_results(status, body)
+                if response is not None:
+                    return response
+                metrics.retry(urljoin(self.__doc__, path))
+                async with moving:  # discover it once for all the workers
+                    if path == 'otn/' + self._query_path:
+                        await loop.run_in_executor(None, self.init_query_path)
+            raise AssertionError(
+                'Query path %r is outdated' % self._query_path)
+
+        async def produce():
+            nonlocal total
+            for depart, arrive in pairs:
+                for date in dates:
+                    await jobs.put((depart, arrive, date))
+                    total += 1
+            for _ in range(concurrency):
+                await jobs.put(None)
+
+        async def work():
+            while True:
+                job = await jobs.get()
+                if job is None:
+                    break
+                try:
+                    response = await query(*job)
+                except Exception as e:
+                    failures.append(job + (e,))
+                    continue
+                await results.put([
+                    parse_availability(job[2], train.split('|'))
+                    for train in response.data['result']
+                ])
+            await results.put(None)
+
+        dates = list(dates)
+        with limit:  # only for this scan
+            async with AsyncAPI.from_session(
+                    self, limit_per_host=concurrency) as api:
+                tasks = [asyncio.ensure_future(produce())] + [
+                    asyncio.ensure_future(work()) for _ in range(concurrency)]
+                try:
+                    finished = 0
+                    while finished < concurrency:
+                        records = await results.get()
+                        if records is None:
+                            finished += 1
+                        else:
+                            yield records
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    if failures:
+                        print('X %d of %d queries failed' % (
+                            len(failures), total))
+                    for depart, arrive, date, e in failures:
+                        print('X', depart, arrive, date, repr(e))
+
+    def sweep(
+        self,
+        pairs: Iterable[Tuple[str, str]],
+        dates: Iterable[str],
+        path='availability.db',
+        **kwargs
+    ) -> int:
+        'Scan the availability matrix and stream the records into a table.'
+        async def consume(table: AvailabilityTable) -> int:
+            count = 0
+            async for records in self.scan(pairs, dates, **kwargs):
+                table.extend(records)
+                count += len(records)
+            return count
+
+        with AvailabilityTable(path) as table:
+            return asyncio.run(consume(table))
+
     def load_captcha(self) -> io.BytesIO:
         'Fetch the CAPTCHA image.'
         response = self.get(
@@ -116,7 +314,7 @@ class Ticket(API):
         assert not response.result_code, response.result_message
         print(response.result_message)
         self.get_auth_token()
-        self.save_cookies()
+        self.save_state()
 
     def get_auth_token(self):
         'Get the user authentication tokens in cookies.'
@@ -128,12 +326,16 @@ class Ticket(API):
         assert not response.result_code, response.result_message
         print('%s: %s' % (response.username, response.result_message))
 
-    def save_cookies(self):
-        'Save the cookies in a JSON file.'
+    def save_state(self):
+        'Save the cookies and the query path in a JSON file.'
         if self.persist_cookies:
-            cj = requests.utils.dict_from_cookiejar(self.session.cookies)
+            state = dict(
+                timestamp=time.time(),
+                query_path=self._query_path,
+                cookies=requests.utils.dict_from_cookiejar(self.cookies),
+            )
             with open(self.persist_cookies, 'w') as f:
-                json.dump(cj, f)
+                json.dump(state, f)
 
     def is_logged_in(self) -> bool:
         'Check whether the user is logged in.'
@@ -153,13 +355,7 @@ class Ticket(API):
             'otn/confirmPassenger/initDc',
             key='att', json=False,
         )
-        ticket_info_pattern = re.compile('ticketInfoForPassengerForm=(.*?);')
-        ticket_info_json = ticket_info_pattern.search(response.text).group(1)
-        ticket_info = json.loads(ticket_info_json.replace("'", '"'))
-
-        token_pattern = re.compile("globalRepeatSubmitToken = '(.*?)'")
-        token = token_pattern.search(response.text).group(1)
-        return ticket_info, {'REPEAT_SUBMIT_TOKEN': token}
+        return parse_order_page(response.text)
 
     def left_tickets(self, secret: str) -> Iterable[Tuple[str, str]]:
         'Get the count of remaining train tickets for each coach class.'
@@ -178,6 +374,73 @@ class Ticket(API):
         return response.data['normal_passengers']
 
 
+def parse_order_page(page: str) -> Tuple[dict, dict]:
+    'Extract the ticket info and the submit token from the order page.'
+    ticket_info_pattern = re.compile('ticketInfoForPassengerForm=(.*?);')
+    ticket_info_json = ticket_info_pattern.search(page).group(1)
+    ticket_info = json.loads(ticket_info_json.replace("'", '"'))
+
+    token_pattern = re.compile("globalRepeatSubmitToken = '(.*?)'")
+    token = token_pattern.search(page).group(1)
+    return ticket_info, {'REPEAT_SUBMIT_TOKEN': token}
+
+
+def seat_count(text: str) -> Optional[int]:
+    'Convert the seat count text, or return None if the class is not sold.'
+    if text.isdigit():
+        return int(text)
+    return {'有': PLENTY, '无': 0}.get(text)
+
+
+def parse_availability(date: str, train: List[str]) -> Availability:
+    'Pick the named fields from a row of the left ticket query results.'
+    seats = (seat_count(train[i]) for i in SEAT_COLUMNS.values())
+    return Availability(date, *train[2:4], *train[6:11], train[11] == 'Y', *seats)
+
+
+class AvailabilityTable:
+    'Append availability records to a CSV file or an SQLite database.'
+
+    def __init__(self, path: str):
+        'Open the file by its extension, and create the table if necessary.'
+        if path.endswith('.csv'):
+            new_file = not os.path.exists(path)
+            self.file = open(path, 'a', newline='')
+            self.writer = csv.writer(self.file)
+            if new_file:
+                self.writer.writerow(Availability._fields)
+            self.conn = None
+        else:
+            self.conn = sqlite3.connect(path)
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS availability (%s, PRIMARY KEY '
+                '(date, train_no, depart, arrive)) WITHOUT ROWID' %
+                ', '.join(Availability._fields))
+
+    def __enter__(self) -> 'AvailabilityTable':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def extend(self, records: Iterable[Availability]):
+        'Write the records, and replace the outdated ones in databases.'
+        if self.conn is None:
+            self.writer.writerows(records)
+            self.file.flush()
+            return
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO availability VALUES (%s)' %
+                ','.join('?' * len(Availability._fields)), records)
+
+    def close(self):
+        if self.conn is None:
+            self.file.close()
+        else:
+            self.conn.close()
+
+
 def show_image(file: BinaryIO, img_path='captcha.jpg'):
     'Save the image to a file if Pillow is not installed.'
     try:
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+from typing import Any, Dict, Iterable, List, Tuple
+
+from trains import load_trains, parse_trains
+from util import argv, open, progress, shell, AttrDict
+from wifi12306 import Wifi12306
+
+
+class Timetable:
+    'Stop times of all the trains, stored in SQLite.'
+
+    def __init__(self, path='timetable.db'):
+        'Open the database and create the indexes.'
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS stops (
+                train_no TEXT, seq INTEGER, train_code TEXT,
+                telecode TEXT, station TEXT, arrive TEXT, depart TEXT,
+                distance INTEGER, time_span INTEGER,
+                PRIMARY KEY (train_no, seq)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS stops_by_station
+                ON stops (station, train_no, seq);
+            CREATE INDEX IF NOT EXISTS stops_by_telecode
+                ON stops (telecode, train_no, seq);
+            CREATE TABLE IF NOT EXISTS crawled (
+                train_no TEXT PRIMARY KEY, train_code TEXT, stops INTEGER
+            );
+        ''')
+
+    def missing(self, trains: Dict[str, str]) -> List[Tuple[str, str]]:
+        'Return the trains not yet crawled, so that crawls can be resumed.'
+        done = {row[0] for row in self.conn.execute(
+            'SELECT train_no FROM crawled WHERE stops > 0')}
+        return sorted((k, v) for k, v in trains.items() if k not in done)
+
+    def save(self, train_no: str, train_code: str, stations: List[Dict]):
+        'Replace the stops of a train, and mark it as crawled.'
+        with self.conn:
+            self.conn.execute('DELETE FROM stops WHERE train_no = ?', (train_no,))
+            self.conn.executemany(
+                'INSERT INTO stops VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (normalize_stop(train_no, s) for s in stations))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO crawled VALUES (?, ?, ?)',
+                (train_no, train_code, len(stations)))
+
+    def crawl(
+        self,
+        wifi: Wifi12306,
+        trains: Dict[str, str],
+        query_date: date=None,
+        max_workers=4,
+    ):
+        'Fetch the stop times of the missing trains in a worker pool.'
+        trains = self.missing(trains)
+        print('%d trains to be crawled.' % len(trains))
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = {
+                executor.submit(
+                    wifi.stop_time_by_train_code, train_code, query_date):
+                (train_no, train_code)
+                for train_no, train_code in trains
+            }
+            for future in as_completed(futures):
+                try:
+                    stations = future.result()
+                except Exception as e:
+                    print(*futures[future], e)
+                else:
+                    if not stations:  # try again in the next crawl
+                        print(*futures[future], 'no stop times')
+                        continue
+                    self.save(*futures[future], stations)
+                    progress()
+        print()
+
+    def between(self, depart: str, arrive: str) -> List[AttrDict]:
+        'List the trains from one station to another, by names or telecodes.'
+        column = 'telecode' if depart.isupper() else 'station'
+        cursor = self.conn.execute('''
+            SELECT a.train_no, a.train_code, a.station, b.station,
+                a.depart, b.arrive, b.distance - a.distance,
+                b.time_span - a.time_span
+            FROM stops a JOIN stops b
+                ON a.train_no = b.train_no AND a.seq < b.seq
+            WHERE a.{0} = ? AND b.{0} = ?
+            ORDER BY a.depart
+        '''.format(column), (depart, arrive))
+        fields = (
+            'train_no train_code depart_station arrive_station '
+            'depart arrive distance time_span'
+        ).split()
+        return [AttrDict(zip(fields, row)) for row in cursor]
+
+
+def normalize_stop(train_no: str, s: Dict[str, Any]) -> tuple:
+    'Pick the fields of a stop from the query results.'
+    return (
+        train_no, int(s['stationNo']), s['stationTrainCode'],
+        s['stationTelecode'], s['stationName'],
+        s['arriveTime'], s['startTime'],
+        int(s['distance'] or 0), int(s['timeSpan'] or 0),
+    )
+
+
+def unique_trains(routes: Iterable[Tuple]) -> Dict[str, str]:
+    'Map each train_no to one of its train codes.'
+    return {train_no: train_code for train_no, train_code, *_ in routes}
+
+
+if __name__ == '__main__':
+    with open(argv(1) or 'train_list.js') as f:
+        trains = unique_trains(parse_trains(load_trains(f.read())))
+    query_date = date.fromisoformat(argv(2)) if argv(2) else None
+    t = Timetable()
+    t.crawl(Wifi12306(), trains, query_date)
+    shell(vars(), 't.between("北京南", "上海虹桥")')
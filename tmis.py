@@ -4,7 +4,10 @@ import json
 import requests
 from collections import OrderedDict
 
+import metrics
+from tickets import API
 from util import repl, progress
+web = API()
 
 
 def tmis(name='', bureau=0) -> OrderedDict:
@@ -14,9 +17,10 @@ def tmis(name='', bureau=0) -> OrderedDict:
     params.update(q=name, ljdm=format(bureau, '02'))
     while True:
         try:
-            response = requests.post(url, params, timeout=1).json()
+            response = web.post(url, params, timeout=1, json=False).json()
         except (requests.exceptions.Timeout, json.JSONDecodeError):
             progress('X')
+            metrics.retry(url)
         else:
             break
     return OrderedDict((d['HZZM'], d['TMISM']) for d in response)
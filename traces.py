@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Optional
+
+from util import argv, shell, AttrDict
+
+
+class Traces:
+    'Append-only history of the freight tracking results, stored in SQLite.'
+
+    def __init__(self, path='traces.db', retention=90 * 86400):
+        'Open the database; the events older than retention are compactable.'
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.executescript('''
+                PRAGMA journal_mode = WAL;
+                PRAGMA synchronous = NORMAL;
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY, recorded REAL, event_date TEXT,
+                    car_no TEXT, train TEXT, station TEXT, data TEXT,
+                    UNIQUE (car_no, event_date, station, train)
+                );
+                CREATE INDEX IF NOT EXISTS events_by_train
+                    ON events (train, event_date);
+                CREATE INDEX IF NOT EXISTS events_by_station
+                    ON events (station, event_date);
+            ''')
+
+    def append(self, info: Mapping[str, Any], train='') -> bool:
+        'Record a tracking result, unless the same event is already known.'
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO events VALUES (NULL, ?, ?, ?, ?, ?, ?)',
+                (time.time(), str(info.get('eventDate', '')).strip(),
+                 str(info.get('carNo', '')).strip(), train.strip(),
+                 str(info.get('eventStation', '')).strip(),
+                 json.dumps(info, ensure_ascii=False)))
+            return cursor.rowcount > 0
+
+    def query(self, where: str, *params) -> List[AttrDict]:
+        'Select the events in chronological order.'
+        with self.lock:
+            cursor = self.conn.execute(
+                'SELECT data FROM events WHERE %s ORDER BY event_date, id'
+                % where, params)
+            return [AttrDict(json.loads(data)) for data, in cursor]
+
+    def trajectory(self, car_no: str, since='', until=None) -> List[AttrDict]:
+        'List the events of a car or container, like "2026-10-12" onwards.'
+        if until is None:
+            return self.query('car_no = ? AND event_date >= ?', car_no, since)
+        return self.query(
+            'car_no = ? AND event_date >= ? AND event_date < ?',
+            car_no, since, until)
+
+    def by_train(self, train: str, since='') -> List[AttrDict]:
+        'List the events of the cars seen in a train.'
+        return self.query('train = ? AND event_date >= ?', train, since)
+
+    def by_station(self, station: str, since='') -> List[AttrDict]:
+        'List the events happened at a station.'
+        return self.query('station = ? AND event_date >= ?', station, since)
+
+    def latest(self, train: str) -> Optional[AttrDict]:
+        'Return the last known event of a train.'
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT data FROM events WHERE train = ? '
+                'ORDER BY event_date DESC, id DESC LIMIT 1', (train,)
+            ).fetchone()
+        return row and AttrDict(json.loads(row[0]))
+
+    # the mapping interface of the former known_traces dict
+    def __contains__(self, train: str) -> bool:
+        with self.lock:
+            return self.conn.execute(
+                'SELECT 1 FROM events WHERE train = ? LIMIT 1', (train,)
+            ).fetchone() is not None
+
+    def __getitem__(self, train: str) -> AttrDict:
+        info = self.latest(train)
+        if info is None:
+            raise KeyError(train)
+        return info
+
+    def __setitem__(self, train: str, info: Mapping[str, Any]):
+        self.append(info, train)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT count(*) FROM events').fetchone()[0]
+
+    def compact(self, retention: float=None) -> int:
+        'Delete the old events except the latest one of each train.'
+        deadline = time.time() - (retention or self.retention)
+        with self.lock, self.conn:
+            cursor = self.conn.execute('''
+                DELETE FROM events WHERE recorded < ? AND id NOT IN (
+                    SELECT max(id) FROM events WHERE train != ''
+                    GROUP BY train)
+            ''', (deadline,))
+        with self.lock:
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return cursor.rowcount
+
+    def import_json(self, traces: Dict[str, Mapping[str, Any]]) -> int:
+        'Migrate the latest results per train from the former JSON file.'
+        return sum(self.append(info, train) for train, info in traces.items())
+
+
+if __name__ == '__main__':
+    t = Traces(argv(1) or 'traces.db')
+    shell(vars(), 'len(t) == %d.' % len(t))
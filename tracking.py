@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
 
 import base64
+import contextvars
 import json
 import io
+import logging
 import re
-
-from typing import List, Mapping
+import sys
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, TextIO
+from urllib.parse import urlsplit
 from pyquery import PyQuery
 
-from util import module_dir, repl, strip_lines, AttrDict, FilterFormatter
+import throttle
+from util import argv, module_dir, open, repl, strip_lines
+from util import AttrDict, FilterFormatter
 from tickets import show_image, API
+from traces import Traces
 
 CAR_OR_CONTAINER_PATTERN = re.compile(r'([A-Z]{4})?[0-9]{7}')
+CAPTCHA_ERROR = '验证码错误'
+NOT_FOUND = '没有满足条件的查询结果'
 
 
 class Tracking(API):
@@ -125,17 +140,22 @@ class CrscTracking(Tracking):
     def track_car(self, car_no: str='5624520') -> AttrDict:
         'Track your rail shipment by car number.'
         params = {'operFlag': 'chcx', 'qo.truckcode': car_no}
-        page = self.get(None, params, json=False)
-        first_row = PyQuery(page.text)('center tr:nth-child(2)>td')
+        return self.parse(self.get(None, params, json=False).text)
+
+    @classmethod
+    def parse(cls, page: str) -> AttrDict:
+        'Pick the first row of the result table.'
+        first_row = PyQuery(page)('center tr:nth-child(2)>td')
         assert first_row, None
         return dict(zip(
-            self.fields,
+            cls.fields,
             (cell.text_content().strip() for cell in first_row)
         ))
 
 
 class HyfwTracking(Tracking):
     'http://hyfw.95306.cn/gateway/hywx/TrainWebClient/'
+    timeout = 15  # secs, so that a stuck request returns its pooled session
 
     def __init__(self):
         'Initialize the session.'
@@ -161,11 +181,16 @@ class HyfwTracking(Tracking):
         'Send the tracking request and parse the response message.'
         # insert the namespace prefix for each key
         data = {'hwzz.' + k: v for k, v in kwargs.items()}
-        response = self.post('hwzz_uouii.action', data=data)
-        assert response.success, response.get('message', response.get('msg'))
+        response = self.post(
+            'hwzz_uouii.action', data=data, timeout=self.timeout)
+        message = response.get('message', response.get('msg'))
+        if not response.success and '稍后再试' in str(message):
+            throttle.feedback(self.__doc__, blocked=True)
+        assert response.success, message
         return self.decipher(response.object)[0]
 
-    def decipher(self, s: str):
+    @staticmethod
+    def decipher(s: str):
         'Decipher the base64-encoded messages.'
         for trim in 0, 0, 8:
             s = base64.b64decode(s[:len(s) - trim])
@@ -180,6 +205,259 @@ class HyfwTracking(Tracking):
         return self.track(type=5, xz=container_no[:4], xh=container_no[4:])
 
 
+class HyfwSessionPool:
+    'Keep authenticated sessions warm in the background, and lease them.'
+
+    def __init__(self, size=2, max_age=1800, timeout=60, retries=2):
+        'Set the number of sessions, and the seconds to retire them.'
+        self.size, self.max_age = size, max_age
+        self.timeout, self.retries = timeout, retries
+        self.idle = []  # of (authenticated time, session), the newest last
+        self.leased = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def start(self) -> 'HyfwSessionPool':
+        'Start authenticating the sessions, if not started yet.'
+        with self.cond:
+            if not self.thread:
+                self.thread = threading.Thread(
+                    target=self.keep_warm, name='hyfw-pool', daemon=True)
+                self.thread.start()
+        return self
+
+    def needed(self) -> bool:
+        'Retire the stale sessions, and tell if any more is needed.'
+        deadline = time.monotonic() - self.max_age
+        self.idle = [(t, s) for t, s in self.idle if t > deadline]
+        return len(self.idle) + self.leased < self.size
+
+    def keep_warm(self):
+        'Solve the CAPTCHA for new sessions whenever needed.'
+        failures = 0
+        while True:
+            with self.cond:
+                if not self.cond.wait_for(self.needed, self.max_age / 4):
+                    continue
+            try:
+                session = authenticate()
+            except Exception as e:
+                failures += 1
+                logging.warning('Failed to authenticate: %r', e)
+                time.sleep(min(2 ** failures, 300))
+                continue
+            failures = 0
+            with self.cond:
+                self.idle.append((time.monotonic(), session))
+                self.cond.notify_all()
+
+    @contextmanager
+    def lease(self) -> Iterator[HyfwTracking]:
+        'Borrow a session, which is dropped if its CAPTCHA has expired.'
+        self.start()
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.idle, self.timeout):
+                raise TimeoutError('No authenticated session available')
+            authenticated, session = self.idle.pop()
+            self.leased += 1
+        expired = False
+        try:
+            yield session
+        except AssertionError as e:
+            expired = CAPTCHA_ERROR in str(e)
+            raise
+        finally:
+            with self.cond:
+                self.leased -= 1
+                if not expired:
+                    self.idle.append((authenticated, session))
+                self.cond.notify_all()
+
+    def track(self, method: str, *args) -> AttrDict:
+        'Send the request, and retry with another session on CAPTCHA errors.'
+        for attempt in range(self.retries + 1):
+            try:
+                with self.lease() as session:
+                    return getattr(session, method)(*args)
+            except AssertionError as e:
+                if CAPTCHA_ERROR not in str(e) or attempt == self.retries:
+                    raise
+
+    def track_car(self, car_no: str) -> AttrDict:
+        return self.track('track_car', car_no)
+
+    def track_container(self, container_no: str) -> AttrDict:
+        return self.track('track_container', container_no)
+
+
+class HedgedTracking:
+    'Race the tracking backends, starting each after a delay if needed.'
+
+    def __init__(self, *backends: Callable[[str], Mapping], delay=1.0,
+                 adaptive=True, max_workers=8, max_losers=1):
+        'Take the backends in the order of preference.'
+        self.backends, self.delay, self.adaptive = backends, delay, adaptive
+        self.max_losers = max_losers
+        self.losers = 0  # calls still running after their races are over
+        self.names = [b.__qualname__ for b in backends]
+        self.races = 0
+        self.wins = [0] * len(backends)
+        self.failures = [0] * len(backends)
+        self.latencies = [deque(maxlen=200) for b in backends]
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers, 'hedge')
+
+    def timed(self, i: int, number: str) -> Mapping:
+        'Call a backend, and record its latency of valid results.'
+        start = time.monotonic()
+        try:
+            result = self.backends[i](number)
+            assert result, None
+        except Exception:
+            with self.lock:
+                self.failures[i] += 1
+            raise
+        with self.lock:
+            self.latencies[i].append(time.monotonic() - start)
+        return result
+
+    def __call__(self, number: str) -> Mapping:
+        'Return the first valid result, or raise the error of the last one.'
+        pending, errors = {}, {}
+        for i in range(len(self.backends)):
+            context = contextvars.copy_context()  # keep the throttle lane
+            pending[self.executor.submit(
+                context.run, self.timed, i, number)] = i
+            last = i == len(self.backends) - 1 or self.saturated()
+            while pending:
+                done, _ = wait(
+                    pending, None if last else self.delay, FIRST_COMPLETED)
+                if not done:
+                    break  # too slow, hedge with the next backend
+                for future in done:
+                    winner = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        errors[winner] = e
+                        continue
+                    for future in pending:
+                        if not future.cancel():
+                            self.abandon(future)
+                    self.record(winner)
+                    return result
+        self.record(None)
+        raise errors[max(errors)]  # the fallbacks tell more, like hyfw
+
+    def saturated(self) -> bool:
+        'Tell if too many losers still hold resources, like pooled sessions.'
+        with self.lock:
+            return self.losers >= self.max_losers
+
+    def abandon(self, future):
+        'Count a running loser until it finishes, for it cannot be stopped.'
+        def finished(future):
+            with self.lock:
+                self.losers -= 1
+        with self.lock:
+            self.losers += 1
+        future.add_done_callback(finished)
+
+    def record(self, winner: int=None):
+        'Count the race, and tune the delay from time to time.'
+        with self.lock:
+            self.races += 1
+            if winner is not None:
+                self.wins[winner] += 1
+        if self.adaptive and self.races % 20 == 0:
+            self.tune()
+
+    def tune(self, quantile=0.9, bounds=(0.1, 10.0)):
+        'Hedge when the first backend is slower than usual for valid results.'
+        with self.lock:
+            latencies = sorted(self.latencies[0])
+            if latencies:
+                delay = latencies[int(quantile * (len(latencies) - 1))]
+                self.delay = min(max(delay, bounds[0]), bounds[1])
+
+    def report(self) -> Dict[str, AttrDict]:
+        'Summarize the win rate and latency percentiles of each backend.'
+        with self.lock:
+            summary = {}
+            for i, name in enumerate(self.names):
+                latencies = sorted(self.latencies[i])
+                percentile = lambda q: latencies and round(
+                    latencies[int(q * (len(latencies) - 1))], 3)
+                summary[name] = AttrDict(
+                    wins=self.wins[i], failures=self.failures[i],
+                    win_rate=round(self.wins[i] / (self.races or 1), 3),
+                    p50=percentile(0.5), p90=percentile(0.9))
+            return summary
+
+    def track_car(self, car_no: str) -> Mapping:
+        return self(car_no)
+
+
+def track_batch(
+    pool: HyfwSessionPool,
+    numbers: Iterable[str],
+    output: TextIO,
+    attempts=3,
+    backoff=2.0,
+    rate: float=None,
+    traces: Traces=None,
+) -> int:
+    'Track the numbers concurrently, and write JSON lines in input order.'
+    limit = throttle.override(urlsplit(HyfwTracking.__doc__).netloc, rate) \
+        if rate else nullcontext()
+    formatter = Tracking()
+
+    def track(number: str) -> dict:
+        record = dict(number=number, time=datetime.now().isoformat())
+        if not CAR_OR_CONTAINER_PATTERN.fullmatch(number):
+            return dict(record, error='Invalid number', attempts=0)
+        method = 'track_car' if number.isdigit() else 'track_container'
+        for attempt in range(1, attempts + 1):
+            try:
+                info = pool.track(method, number)
+            except AssertionError as e:
+                if NOT_FOUND in str(e):  # a final answer, not a failure
+                    return dict(record, error=str(e), attempts=attempt)
+                error = str(e)
+            except Exception as e:
+                error = repr(e)
+            else:
+                info = dict(info, carNo=number, trainId=info.get('trainId', ''))
+                if traces is not None:
+                    traces.append(info, info['trainId'])
+                return dict(
+                    record, result=info, explanation=formatter.explain(info),
+                    attempts=attempt)
+            if attempt < attempts:
+                time.sleep(backoff * 2 ** (attempt - 1))
+        return dict(record, error=error, attempts=attempts)
+
+    count = 0
+    numbers = (line.strip().upper() for line in numbers)
+    window = deque()  # the futures in the input order, a few at a time
+
+    def write_oldest():
+        nonlocal count
+        record = window.popleft().result()
+        print(json.dumps(record, ensure_ascii=False), file=output)
+        output.flush()
+        count += 1
+
+    with limit, ThreadPoolExecutor(pool.size) as executor:
+        for number in filter(None, numbers):
+            if len(window) >= 2 * pool.size:  # read the input as it goes
+                write_oldest()
+            window.append(executor.submit(track, number))
+        while window:
+            write_oldest()
+    return count
+
+
 def solve_captcha(captcha_image: io.BytesIO) -> str:
     'Solve the CAPTCHA image.'
     from captcha.captcha import image_filter, solve
@@ -189,6 +467,22 @@ def solve_captcha(captcha_image: io.BytesIO) -> str:
     return ''.join(map(str, answer_digits))
 
 
+def authenticate(attempts=5) -> HyfwTracking:
+    'Answer the CAPTCHA automatically to get a valid session.'
+    x = HyfwTracking()
+    for i in range(attempts):
+        x.fill_captcha(solve_captcha(x.load_captcha()))
+        try:
+            x.track_car()
+        except AssertionError as e:
+            if CAPTCHA_ERROR in str(e):
+                continue
+            elif NOT_FOUND not in str(e):
+                raise
+        return x
+    raise AssertionError(CAPTCHA_ERROR)
+
+
 def auth():
     'Load and answer the CAPTCHA to get a valid session.'
     x = HyfwTracking()
@@ -213,4 +507,14 @@ def auth():
 
 
 if __name__ == '__main__':
-    repl(auth().repl_handler)
+    if not argv(1):
+        repl(auth().repl_handler)
+    else:
+        # only close the files opened here, never the standard streams
+        source = nullcontext(sys.stdin) if argv(1) == '-' else open(argv(1))
+        output = (open(argv(2), 'w') if argv(2) not in ('', '-') else
+                  nullcontext(sys.stdout))
+        with source as source, output as output:
+            track_batch(
+                HyfwSessionPool(size=int(argv(3) or 4)), source, output,
+                traces=Traces())
@@ -34,6 +34,16 @@ def parse_trains(data: dict) -> Iterable[Tuple[str, str, str, str]]:
                 yield tuple([train[0]] + decompose(train[1]))
 
 
+def emu_codes(data: dict, code_types='DGC') -> Iterable[str]:
+    'Return the train codes within specific categories.'
+    for day, trains in data.items():
+        if not trains:
+            continue
+        for code_type in code_types:
+            for train in trains[code_type]:
+                yield decompose(train['station_train_code'])[0]
+
+
 def sort_trains(routes: Iterable[Tuple]) -> Dict[str, Tuple[str, str, str]]:
     'Match trains with multiple train numbers.'
     trains = {}
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
+import re
 import sys
 import os.path
 import string
 import builtins
-from typing import Callable
+import functools
+from typing import Callable, Optional
+
+DAY = 1440  # minutes
 
 
 class AttrDict(dict):
@@ -16,9 +20,27 @@ class AttrDict(dict):
 class FilterFormatter(string.Formatter):
     'Return an empty string for values that are interpreted as boolean false.'
 
-    def get_field(self, field_name, args, kwargs):
+    def vformat(self, format_string, args, kwargs):
+        'Render the cached plan of the template.'
+        return self.render(compile_template(format_string), args, kwargs)
+
+    def render(self, plan: tuple, args, kwargs) -> str:
+        'Evaluate the literals and fields in a compiled template.'
+        result = []
+        for item in plan:
+            if item.__class__ is str:
+                result.append(item)
+                continue
+            first, rest, conversion, spec = item
+            obj = self.resolve(first, rest, args, kwargs)
+            if conversion:
+                obj = self.convert_field(obj, conversion)
+            spec = self.render(spec, args, kwargs) if spec else ''
+            result.append(self.format_field(obj, spec))
+        return ''.join(result)
+
+    def resolve(self, first, rest, args, kwargs):
         'Return the argument formatted by the format string in the brackets.'
-        first, rest = string._string.formatter_field_name_split(field_name)
         obj = args[first] if isinstance(first, int) else kwargs.get(first, '')
 
         for is_attr, i in rest:
@@ -29,7 +51,45 @@ class FilterFormatter(string.Formatter):
             else:
                 obj = ''
 
-        return obj, first
+        return obj
+
+    def get_field(self, field_name, args, kwargs):
+        'Resolve a field for the uncompiled code path of string.Formatter.'
+        first, rest = string._string.formatter_field_name_split(field_name)
+        return self.resolve(first, rest, args, kwargs), first
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(template: str) -> tuple:
+    'Parse a template into literals and (first, rest, conversion, spec).'
+    return _compile(template, 2, 0)[0]
+
+
+def _compile(template: str, depth: int, auto_index) -> tuple:
+    'Follow the field numbering and recursion rules of string.Formatter.'
+    if depth < 0:
+        raise ValueError('Max string recursion exceeded')
+    plan = []
+    for literal, field_name, spec, conversion in \
+            string._string.formatter_parser(template):
+        if literal:
+            plan.append(literal)
+        if field_name is None:
+            continue
+        if field_name == '':
+            if auto_index is False:
+                raise ValueError('cannot switch from manual field '
+                                 'specification to automatic field numbering')
+            field_name, auto_index = str(auto_index), auto_index + 1
+        elif field_name.isdigit():
+            if auto_index:
+                raise ValueError('cannot switch from manual field '
+                                 'specification to automatic field numbering')
+            auto_index = False
+        first, rest = string._string.formatter_field_name_split(field_name)
+        spec, auto_index = _compile(spec, depth - 1, auto_index)
+        plan.append((first, tuple(rest), conversion, spec))
+    return tuple(plan), auto_index
 
 
 def strip_lines(text: str, sep='') -> str:
@@ -37,6 +97,13 @@ def strip_lines(text: str, sep='') -> str:
     return sep.join(line.strip() for line in text.split('\n'))
 
 
+def minutes(hhmm: str) -> Optional[int]:
+    'Convert "HH:MM" to minutes, or return None for placeholders like "--".'
+    match = re.fullmatch(r'(\d+):(\d+)', hhmm or '')
+    if match:
+        return int(match.group(1)) * 60 + int(match.group(2))
+
+
 def progress(dot='.', file=sys.stdout):
     'Print a progress bar.'
     file.write(dot)
@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 
-from datetime import date
+import contextvars
+import json
+import logging
+import sqlite3
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
 from itertools import chain
 from operator import itemgetter
 from os.path import commonprefix
 from tickets import API
 from typing import Any, Iterable, Dict, List, Optional, Tuple
-from util import repl, AttrDict
+from util import argv, module_dir, open, repl, AttrDict
 
 
 COMMENT_MAPPING = {
@@ -29,31 +37,95 @@ COMMENT_MAPPING = {
     'Q': "静",
 }
 
+# the results of these endpoints only change with the timetable
+STATIC_ENDPOINTS = {
+    'trainDetailInfo/queryTrainCompileListByTrainNo',
+    'trainDetailInfo/getTrainsetTypeByTrainCode',
+    'trainDetailInfo/queryTrainRunRuleByTrainNoAndDateRange',
+}
+
+# and these change within a day, so they are kept for some seconds only
+VOLATILE_ENDPOINTS = {
+    'trainDetailInfo/queryTrainEquipmentByTrainNo': 600,
+}
+
+# the optional parts of a train report, besides the basic info
+REPORT_PARTS = (
+    'train_equipment', 'train_set_type', 'train_compile_list', 'pre_seq_train')
+
+
+def load_timetable_changes(
+    path='timetable_changes.txt', max_age=180,
+) -> List[str]:
+    'Load the effective dates of the timetables, skipping the comments.'
+    try:
+        with open(module_dir(path)) as f:
+            changes = [
+                line.split()[0] for line in f
+                if line.strip() and not line.startswith('#')]
+    except FileNotFoundError:
+        return []
+    latest = max(changes, default=None)
+    # revisions come about twice a year, so one is likely missing by then
+    if latest and (date.today() - date.fromisoformat(latest)).days > max_age:
+        logging.warning(
+            'The latest timetable change in %s is %s; add the newer ones.',
+            path, latest)
+    return changes
+
+
+# to be updated in timetable_changes.txt on each revision
+TIMETABLE_CHANGES = load_timetable_changes()
+
 
 class Wifi12306(API):
     'https://wifi.12306.cn/wifiapps/ticket/api/'
 
-    def __init__(self):
+    def __init__(self, cache: 'MetadataCache'=None):
         super().__init__()
+        self.cache = cache
         self.headers.update({
             'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 15_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148 MicroMessenger/8.0.20(0x18001428) NetType/4G Language/zh_CN',
         })
 
-    def request(self, *args, json=True, **kwargs):
-        resp = super().request(*args, json=json, **kwargs)
+    def request(self, method, path, *args, json=True, **kwargs):
+        cacheable = self.cache and json and path in self.cache.endpoints
+        if cacheable:
+            found, data = self.cache.get(path, kwargs.get('params', {}))
+            if found:
+                return data
+
+        resp = super().request(method, path, *args, json=json, **kwargs)
         if not json:
             return resp
         if resp.get('status', -1):
             raise APIError(resp.get('error'))
+
+        if cacheable:
+            self.cache.put(path, kwargs.get('params', {}), resp.get('data'))
         return resp.get('data')
 
+    def warm_up(self, train_nos: Iterable[str], max_workers=4):
+        'Fill the cache with the static metadata of the trains.'
+        def fetch(train_no: str):
+            try:
+                self.train_compile_list_by_train_no(train_no)
+                self.train_set_type_by_train_code(train_no)
+            except Exception as e:
+                print(train_no, e)
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            for i, _ in enumerate(executor.map(fetch, train_nos), 1):
+                if i % 100 == 0:
+                    print(i, 'trains cached.')
+
     @staticmethod
     def yyyymmdd_format(date: date) -> str:
         return date.isoformat().replace('-', '')
 
     @staticmethod
     def from_yyyymmdd_format(s: str) -> date:
-        return date.fromisoformat('{0[:4]}-{0[4:6]}-{0[6:8]}'.format(s))
+        return date(int(s[:4]), int(s[4:6]), int(s[6:8]))
 
     def train_list_by_station_name(
         self,
@@ -212,11 +284,51 @@ class Wifi12306(API):
                     train_compile_list, key=itemgetter('coachNo'))),
         ))
 
+    def train_report(
+        self, train_code: str, parts: Iterable[str]=REPORT_PARTS,
+    ) -> AttrDict:
+        'Query the info and the parts of a train, sending them in parallel.'
+        parts = set(parts)
+        report = AttrDict(
+            info=None, train_equipment=None, train_set_type=None,
+            train_compile_list=None, pre_seq_train=None,
+            timings={}, errors={})
+
+        def timed(part: str, method, *args):
+            start = time.monotonic()
+            try:
+                report[part] = method(*args)
+            except Exception as e:
+                report.errors[part] = e
+            finally:
+                report.timings[part] = time.monotonic() - start
+
+        def submit(part: str, method, *args):
+            # keep the request priority of the caller in the worker threads
+            context = contextvars.copy_context()
+            return executor.submit(context.run, timed, part, method, *args)
+
+        with ThreadPoolExecutor(4) as executor:
+            if 'pre_seq_train' in parts:
+                submit(
+                    'pre_seq_train', self.pre_seq_train_by_train_code,
+                    train_code)
+            timed('info', self.info_by_train_code, train_code)
+            if report.info:
+                for part, method in [
+                    ('train_equipment', self.train_equipment_by_train_no),
+                    ('train_set_type', self.train_set_type_by_train_code),
+                    ('train_compile_list', self.train_compile_list_by_train_no),
+                ]:
+                    if part in parts:
+                        submit(part, method, report.info.train_no)
+        return report
+
     def repl_handler(self, train_code: str) -> str:
-        try:
-            info = self.info_by_train_code(train_code)
-        except APIError as e:
-            print(e)
+        report = self.train_report(train_code)
+        info = report.info
+        if not info:
+            print(report.errors.get('info', 'Not found: %s' % train_code))
             return '> '
 
         print(
@@ -224,31 +336,110 @@ class Wifi12306(API):
             '{end_station[stationName]}，{distance} km，'
             '{time_span[0]:02}:{time_span[1]:02}）'.format_map(info))
 
-        train_equipment = self.train_equipment_by_train_no(info.train_no)
-        if train_equipment:
-            print(self.explain_train_equipment(train_equipment))
-        else:
-            train_set_type = self.train_set_type_by_train_code(info.train_no)
-            if train_set_type:
-                print('{trainsetType}{trainsetTypeName}'.format_map(
-                    train_set_type))
+        if report.train_equipment:
+            print(self.explain_train_equipment(report.train_equipment))
+        elif report.train_set_type:
+            print('{trainsetType}{trainsetTypeName}'.format_map(
+                report.train_set_type))
 
-        train_compile_list = self.train_compile_list_by_train_no(info.train_no)
-        if train_compile_list:
-            print(self.explain_train_compile_list(train_compile_list))
+        if report.train_compile_list:
+            print(self.explain_train_compile_list(report.train_compile_list))
 
         print(self.explain_stop_time(info.stations))
 
-        pre_seq_train = self.pre_seq_train_by_train_code(train_code)
-        if pre_seq_train:
-            print(self.explain_pre_seq_train(pre_seq_train))
+        if report.pre_seq_train:
+            print(self.explain_pre_seq_train(report.pre_seq_train))
 
+        for part, e in report.errors.items():
+            print('%s: %s' % (part, e))
         return '> '
 
 
+class MetadataCache:
+    'Keep the train metadata on disk until the timetable changes.'
+
+    def __init__(
+        self,
+        path='wifi12306.db',
+        changes: Iterable[str]=TIMETABLE_CHANGES,
+        max_age=7 * 86400,
+        empty_max_age=600,
+    ):
+        'Open the database, and remove the expired entries.'
+        self.changes = sorted(changes)
+        self.max_age, self.empty_max_age = max_age, empty_max_age
+        self.endpoints = STATIC_ENDPOINTS.union(VOLATILE_ENDPOINTS)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    endpoint TEXT, train TEXT, service_date TEXT, params TEXT,
+                    expires REAL, data TEXT,
+                    PRIMARY KEY (endpoint, train, service_date, params)
+                ) WITHOUT ROWID
+            """)
+            self.conn.execute(
+                'DELETE FROM cache WHERE expires < ?', (time.time(),))
+
+    def key(self, endpoint: str, params: dict) -> Tuple[str, str, str, str]:
+        'Identify the entry by train number and timetable period.'
+        params = dict(params)
+        train = params.pop('trainNo', None) or params.pop('trainCode', '')
+        service_date = ''.join(filter(str.isdigit, str(
+            params.pop('trainDate', '') or params.get('start', ''))))
+        service_date = service_date or date.today().strftime('%Y%m%d')
+        if endpoint in STATIC_ENDPOINTS:
+            # entries within the same timetable period are interchangeable
+            iso_date = datetime.strptime(service_date, '%Y%m%d').date()
+            index = bisect_right(self.changes, iso_date.isoformat())
+            service_date = self.changes[index - 1] if index else ''
+        params = json.dumps(params, sort_keys=True)
+        return endpoint, train, service_date, params
+
+    def expires(self, endpoint: str, service_date: str) -> float:
+        'Expire on the next timetable change, or after the maximum age.'
+        now = time.time()
+        if endpoint in VOLATILE_ENDPOINTS:
+            return now + VOLATILE_ENDPOINTS[endpoint]
+        index = bisect_right(self.changes, service_date)
+        if index == len(self.changes):
+            return now + self.max_age
+        next_change = datetime.fromisoformat(self.changes[index]).timestamp()
+        return min(next_change, now + self.max_age)
+
+    def get(self, endpoint: str, params: dict) -> Tuple[bool, Any]:
+        'Return whether the entry is found, and the data if so.'
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT data FROM cache WHERE endpoint = ? AND train = ? AND '
+                'service_date = ? AND params = ? AND expires >= ?',
+                self.key(endpoint, params) + (time.time(),)).fetchone()
+        return (True, json.loads(row[0])) if row else (False, None)
+
+    def put(self, endpoint: str, params: dict, data: Any):
+        'Save the data until its expiry time, and empty answers only briefly.'
+        key = self.key(endpoint, params)
+        if data:
+            expires = self.expires(endpoint, key[2])
+        else:  # may be a transient failure upstream
+            expires = time.time() + self.empty_max_age
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+                key + (expires, json.dumps(data)))
+
+
 class APIError(ValueError):
     pass
 
 
 if __name__ == '__main__':
-    repl(Wifi12306().repl_handler)
+    wifi = Wifi12306(MetadataCache())
+    if argv(1):
+        from trains import load_trains, parse_trains
+        with open(argv(1)) as f:
+            train_nos = {t[0] for t in parse_trains(load_trains(f.read()))}
+        wifi.warm_up(sorted(train_nos))
+    else:
+        repl(wifi.repl_handler)
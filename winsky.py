@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import re
+from typing import Iterable
+
+from tickets import API
+from util import repl, AttrDict
+web = API()
+
+
+def winsky_handler(registration: str) -> Iterable[AttrDict]:
+    'Identify a civil aircraft by its registration number.'
+    url = 'http://winskywebapp.vipsinaapp.com/winsky/index.php'
+    url += '/home/PlaneInfo/getById?parameter=' + registration
+    return parse_winsky_page(web.get(url, json=False).text)
+
+
+def parse_winsky_page(page: str) -> Iterable[AttrDict]:
+    'Split the table of the aircraft into one dict per aircraft.'
+    page = page.replace(',', '，')
+    matches = re.findall(r'<td><b>([^<]+)</b></td>\s+<td>([^<]*)</td>', page)
+    for i in range(0, len(matches), 10):
+        yield AttrDict(matches[i:i + 10])
+
+
+def main(registration: str):
+    'Format the query results.'
+    for aircraft in winsky_handler(registration.upper()):
+        for k, v in aircraft.items():
+            print('|', k.ljust(5, '　'), v)
+        print()
+
+
+if __name__ == '__main__':
+    repl(main)